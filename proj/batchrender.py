@@ -0,0 +1,141 @@
+""" Render the melody of every recording in testdata, in parallel.
+
+Every ecg csv file (e.g. testdata/[1]/02ecgdata.csv) is processed and
+rendered offline as in nkoffline.py, by a pool of worker processes, one
+for each core, into a WAV file named after the recording (e.g. 
+1_02.wav). The ECG is read from the binary bundle (see recording.py) 
+instead of the csv file when there is one, unless the csv file was 
+changed after the bundle was written. A manifest in the output 
+directory keeps a hash of the inputs of each WAV with its timings: 
+recordings whose inputs have not changed since they were last rendered 
+are skipped.
+
+Run from this directory:
+    python batchrender.py [output directory] [testdata directory]
+"""
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from nkoffline import melodyWindows, WINDOW_SPAN
+from sonification import render
+from recording import BUNDLE_SUFFIX
+
+MANIFEST='manifest.json'
+# rendered after the last window of each recording
+TAIL=10.0
+
+
+def discover(root):
+    """ The recordings under root, as a dictionary mapping a name such as
+    '1_02' to the (ecg, csv) pair of the file the ECG is read from and 
+    the csv file of the recording. The ECG is read from the bundle of the
+    csv file when there is one that is not older than the csv file """
+    recordings={}
+    pattern=os.path.join(glob.escape(root), '*', '*ecgdata.csv')
+    for csv_path in sorted(glob.glob(pattern)):
+        prefix=csv_path[:-len('ecgdata.csv')]
+        ecg_path=csv_path
+        bundle_path=prefix+'ecgdata'+BUNDLE_SUFFIX
+        # a bundle left behind by an edited csv file is ignored
+        if os.path.exists(bundle_path) and (os.path.getmtime(bundle_path)
+                                            >=os.path.getmtime(csv_path)):
+            ecg_path=bundle_path
+        group=os.path.basename(os.path.dirname(prefix)).strip('[]')
+        recordings[f"{group}_{os.path.basename(prefix)}"]=(ecg_path, 
+                                                          csv_path)
+    return recordings
+
+
+def input_hash(paths, span=WINDOW_SPAN):
+    """ Hash of the contents of the input files and of the rendering
+    parameters """
+    digest=hashlib.sha256(f"{span} {TAIL}".encode())
+    for path in paths:
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1<<20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def render_recording(ecg_path, wav_path, span=WINDOW_SPAN):
+    """ Process and render one recording; runs in a worker process.
+    Returns a dictionary of timings """
+    start=time.perf_counter()
+    windows=melodyWindows(ecg_path, span)
+    processing=time.perf_counter()-start
+    if not windows:
+        return {'windows': 0, 'processing': processing}
+    speedup=render(windows, wav_path, span=span, tail=TAIL)
+    duration=len(windows)*span+TAIL
+    return {'windows': len(windows), 'processing': processing,
+            'audio': duration, 'rendering': duration/speedup,
+            'speedup': speedup}
+
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def batch_render(output, root='testdata', workers=None):
+    """ Render every recording under root whose inputs changed since it
+    was last rendered into output; returns the manifest """
+    os.makedirs(output, exist_ok=True)
+    manifest=load_manifest(output)
+    jobs={}
+    for name, (ecg_path, csv_path) in discover(root).items():
+        wav_path=os.path.join(output, name+'.wav')
+        # the hash is of the recording itself, wherever it is read from
+        digest=input_hash([csv_path])
+        entry=manifest.get(name)
+        if entry!=None and entry['hash']==digest and (
+                entry['windows']==0 or os.path.exists(wav_path)):
+            print(f"{name}: unchanged, skipped")
+            continue
+        jobs[name]=(ecg_path, wav_path, digest)
+
+    start=time.perf_counter()
+    workers=os.cpu_count() if workers==None else workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures={pool.submit(render_recording, ecg_path, wav_path): name
+                 for name, (ecg_path, wav_path, digest) in jobs.items()}
+        for future in as_completed(futures):
+            name=futures[future]
+            try:
+                timings=future.result()
+            except Exception as e:
+                print(f"{name}: failed, {e!r}")
+                continue
+            manifest[name]=dict(timings, hash=jobs[name][2])
+            print(summary_line(name, manifest[name]))
+    elapsed=time.perf_counter()-start
+
+    with open(os.path.join(output, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    audio=sum(manifest[name].get('audio', 0) for name in jobs
+              if name in manifest)
+    print(f"Rendered {len(jobs)} recordings ({audio:.0f} s of audio) in "
+          f"{elapsed:.1f} s with {workers} workers")
+    return manifest
+
+
+def summary_line(name, entry):
+    if entry['windows']==0:
+        return f"{name}: no ECG, not rendered"
+    return (f"{name}: {entry['windows']} windows, {entry['audio']:.0f} s of "
+            f"audio; processing {entry['processing']:.2f} s, rendering "
+            f"{entry['rendering']:.2f} s ({entry['speedup']:.1f}x real time)")
+
+
+if __name__ == "__main__":
+    output=sys.argv[1] if len(sys.argv)>1 else 'renders'
+    root=sys.argv[2] if len(sys.argv)>2 else 'testdata'
+    batch_render(output, root)
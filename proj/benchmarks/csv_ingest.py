@@ -0,0 +1,79 @@
+""" Benchmark: parsing of recorded ECG csv files.
+
+The per-row loops that the offline scripts used (re.sub and a float
+list comprehension per row, growing the signal with np.append; or eval
+per row) are compared with the vectorized recording.load_ecg_csv on
+every recording in testdata, and with memory-mapping the same recording
+from a binary bundle (recording.load_ecg_bundle).
+
+Run from this directory:
+    python csv_ingest.py [testdata directory]
+"""
+
+import re
+import sys
+import glob
+import os
+import timeit
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+# Allow importing from parent directory
+sys.path.append('../')
+from recording import load_ecg_csv, load_ecg_bundle, write_ecg_bundle
+
+
+def load_regex(path):
+    """ The loop of the former nkoffline.signalProcessing """
+    qrsdata=pd.read_csv(path)
+    arr=np.array([])
+    offsets=[0]
+    times=[]
+    for item in range(0, len(qrsdata)):
+        clean=re.sub(r'[^\d.\s]', '', qrsdata.loc[item, 'ecg'])
+        conversion=np.array([float(num) for num in clean.split()])
+        arr=np.append(arr, conversion)
+        offsets.append(len(arr))
+        times.append(qrsdata.loc[item, 'time'])
+    return arr, offsets, times
+
+
+def load_eval(path):
+    """ eval() on each row, as test_components/offline.py did """
+    data=pd.read_csv(path)
+    return [np.array(eval(row['ecg'])) for index, row in data.iterrows()]
+
+
+def best(function, path, repeat=3):
+    """ Best time of repeat runs, in ms """
+    return min(timeit.repeat(lambda: function(path), number=1,
+                             repeat=repeat))*1000
+
+
+if __name__ == "__main__":
+    root=sys.argv[1] if len(sys.argv)>1 else '../testdata'
+    paths=sorted(glob.glob(os.path.join(glob.escape(root), '*',
+                                        '*ecgdata.csv')))
+    directory=tempfile.mkdtemp()
+    totals=np.zeros(4)
+    samples=0
+    for index, path in enumerate(paths):
+        recording=load_ecg_csv(path)
+        ecg, offsets, stamps=recording
+        # the regex loop drops the sign of negative samples
+        assert np.array_equal(np.abs(ecg), load_regex(path)[0])
+        bundle=os.path.join(directory, f"{index}.ecgb")
+        write_ecg_bundle(bundle, *recording)
+        times=[best(load_regex, path), best(load_eval, path),
+               best(load_ecg_csv, path), best(load_ecg_bundle, bundle)]
+        totals+=times
+        samples+=len(ecg)
+        print(f"{path}: {len(ecg)} samples in {len(offsets)-1} frames; "
+              f"regex {times[0]:.1f} ms, eval {times[1]:.1f} ms, "
+              f"vectorized {times[2]:.2f} ms, bundle {times[3]:.3f} ms")
+    shutil.rmtree(directory)
+    print(f"Total, {samples} samples: regex {totals[0]:.0f} ms, eval "
+          f"{totals[1]:.0f} ms, vectorized {totals[2]:.1f} ms "
+          f"({totals[0]/totals[2]:.0f}x faster than regex), bundle "
+          f"{totals[3]:.2f} ms")
@@ -0,0 +1,69 @@
+""" Microbenchmark: list vs NumPy decoding of PMD ECG frames.
+
+Recorded ECG frames from testdata are re-encoded into the byte layout
+sent by the Polar H10 and fed to both decoders of PolarMeasurementData.
+The same samples are then encoded as delta-compressed frames, which are
+checked to decode back to the recording and timed in the same way.
+
+Run from this directory:
+    python ecg_decode.py [path to ecgdata.csv]
+"""
+
+import sys
+import csv
+import timeit
+# Allow importing bleakheart from parent directory
+sys.path.append('../')
+from bleakheart import PolarMeasurementData
+from blereplay import encode_ecg_frame, encode_delta_frame
+
+
+def load_frames(path):
+    """ Read a recorded ECG csv and re-encode each row as a PMD frame """
+    frames=[]
+    with open(path, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            samples=[int(v) for v in row['ecg'].strip('[]').split(',')]
+            frames.append(encode_ecg_frame(int(row['time']), samples))
+    return frames
+
+
+def bench(decoder, frames, repeat=5):
+    """ Best time per frame in microseconds over repeat runs """
+    def run():
+        for frame in frames:
+            decoder(frame)
+    best=min(timeit.repeat(run, number=1, repeat=repeat))
+    return best/len(frames)*1e6
+
+
+if __name__ == "__main__":
+    path=sys.argv[1] if len(sys.argv)>1 else '../testdata/[1]/02ecgdata.csv'
+    frames=load_frames(path)
+    nsamples=sum((len(frame)-10)//3 for frame in frames)
+    print(f"{len(frames)} frames, {nsamples} samples from {path}")
+
+    pmd=PolarMeasurementData(None, ecg_array=True)
+    # both decoders must agree before timing them
+    for frame in frames:
+        assert pmd._decode_ecg_array(frame).tolist()==pmd._decode_ecg_data(frame)
+
+    t_list=bench(pmd._decode_ecg_data, frames)
+    t_array=bench(pmd._decode_ecg_array, frames)
+    print(f"list decoder:  {t_list:8.2f} us/frame")
+    print(f"array decoder: {t_array:8.2f} us/frame")
+    print(f"speed-up:      {t_list/t_array:8.2f}x")
+
+    compressed=[encode_delta_frame('ECG', 0, pmd._decode_ecg_data(frame), 14)
+                for frame in frames]
+    for frame, packed in zip(frames, compressed):
+        assert pmd._decode_ecg_data(packed)==pmd._decode_ecg_data(frame)
+        assert (pmd._decode_ecg_array(packed).tolist()==
+                pmd._decode_ecg_data(frame))
+    ratio=sum(map(len, compressed))/sum(map(len, frames))
+    t_list=bench(pmd._decode_ecg_data, compressed)
+    t_array=bench(pmd._decode_ecg_array, compressed)
+    print(f"compressed frames are {ratio*100:.0f}% of uncompressed size")
+    print(f"compressed, list decoder:  {t_list:8.2f} us/frame")
+    print(f"compressed, array decoder: {t_array:8.2f} us/frame")
+    print(f"compressed, speed-up:      {t_list/t_array:8.2f}x")
@@ -0,0 +1,93 @@
+""" Check and benchmark of HeartRate frame decoding.
+
+Synthetic heart rate measurement frames are generated for every value of
+the flags byte (uint8/uint16 heart rate, contact bits, energy
+expenditure, 0 to 9 RR intervals) and decoded both by HeartRate._decode
+and by a straightforward byte-by-byte reference decoder written from the
+Bluetooth SIG specification; the two must agree on every frame. The
+decoders are then timed on frames as sent by the Polar H10.
+
+Run from this directory:
+    python hr_decode.py [frames per flags value]
+"""
+
+import sys
+import random
+import timeit
+# Allow importing bleakheart from parent directory
+sys.path.append('../')
+from bleakheart import HeartRate
+
+
+def reference_decode(data):
+    """ Decode a frame one field at a time; returns (payload, contact
+    detection supported) """
+    flags=data[0]
+    payload={}
+    contact_detection=(flags & 4)>0
+    if contact_detection:
+        payload['contact']=(flags & 2)>0
+    if (flags & 1)==0:
+        payload['hr']=data[1]
+        offset=2
+    else:
+        payload['hr']=int.from_bytes(data[1:3], 'little')
+        offset=3
+    if flags & 8:
+        payload['nrg']=int.from_bytes(data[offset:offset+2], 'little')
+        offset+=2
+    if flags & 16:
+        payload['rr']=[round(int.from_bytes(data[i:i+2], 'little')*1000/1024)
+                       for i in range(offset, len(data), 2)]
+    return payload, contact_detection
+
+
+def synthetic_frame(flags, rng):
+    """ A random frame with the given flags byte """
+    frame=bytearray([flags])
+    if flags & 1:
+        frame+=rng.randrange(1<<16).to_bytes(2, 'little')
+    else:
+        frame.append(rng.randrange(256))
+    if flags & 8:
+        frame+=rng.randrange(1<<16).to_bytes(2, 'little')
+    if flags & 16:
+        for i in range(rng.randrange(10)):
+            frame+=rng.randrange(1<<16).to_bytes(2, 'little')
+    # bits 5-7 are reserved and carry no fields
+    return frame
+
+
+def check(frames_per_flags=50, seed=0):
+    """ Compare the decoders on frames_per_flags frames for each of the
+    256 flags values; returns the number of frames checked """
+    rng=random.Random(seed)
+    heartrate=HeartRate(None, callback=lambda frame: None)
+    checked=0
+    for flags in range(256):
+        for i in range(frames_per_flags):
+            frame=synthetic_frame(flags, rng)
+            payload=heartrate._decode(frame)
+            expected, contact_detection=reference_decode(frame)
+            assert payload==expected, (frame.hex(), payload, expected)
+            assert heartrate.contact_detection==contact_detection
+            checked+=1
+    return checked
+
+
+if __name__ == "__main__":
+    count=int(sys.argv[1]) if len(sys.argv)>1 else 50
+    print(f"{check(count)} frames over all 256 flags values decoded "
+          "as the reference does")
+    heartrate=HeartRate(None, callback=lambda frame: None)
+    # Polar H10: uint8 heart rate and one or two RR intervals
+    frames=[bytearray([0x10, 60, 0x00, 0x04]),
+            bytearray([0x10, 60, 0x00, 0x04, 0x10, 0x04])]*500
+    times=[]
+    for name, decoder in [('HeartRate._decode', heartrate._decode),
+                          ('reference', reference_decode)]:
+        best=min(timeit.repeat(lambda: [decoder(frame) for frame in frames],
+                               number=1, repeat=5))
+        times.append(best)
+        print(f"{name}: {best/len(frames)*1e6:.2f} us per frame")
+    print(f"speed-up over the reference: {times[1]/times[0]:.2f}x")
@@ -0,0 +1,47 @@
+""" Load test for SensorManager: how many sensors can one core serve?
+
+The same recording is replayed concurrently as if it came from several
+sensors, each drained by its own consumer, and the per-device throughput,
+dropped samples and CPU time are reported.
+
+Run from this directory:
+    python multisensor_load.py [sensors] [speed] [recording prefix]
+"""
+
+import sys
+import time
+import asyncio
+# Allow importing bleakheart from parent directory
+sys.path.append('../')
+from multisensor import SensorManager, drain
+from blereplay import replay_backend
+
+
+async def run(nsensors, speed, recording):
+    # one replayed device for each sensor; the trailing slashes give each
+    # a distinct address for the same files
+    recordings=[recording.replace('/', '/'*(i+1), 1) for i in range(nsensors)]
+    scanner, client_class=replay_backend(*recordings, speed=speed)
+    manager=SensorManager(scanner, client_class)
+    devices=await manager.discover()
+    quit_event=asyncio.Event()
+    start, cpu=time.perf_counter(), time.process_time()
+    runner=asyncio.create_task(manager.run(devices, quit_event))
+    await asyncio.sleep(0)
+    consumers=[asyncio.create_task(drain(session))
+               for session in manager.sessions.values()]
+    await asyncio.gather(runner, *consumers)
+    elapsed, cpu=time.perf_counter()-start, time.process_time()-cpu
+    for device_id, stats in manager.stats().items():
+        print(f"{device_id}: {stats['ecg_samples']} ECG samples, "
+              f"{stats['ecg_dropped']} dropped, {stats['hr_samples']} beats"
+              f"{', error: '+stats['error'] if stats['error'] else ''}")
+    print(f"{nsensors} sensors: {elapsed:.2f} s wall, {cpu:.2f} s CPU "
+          f"({100*cpu/elapsed:.0f}% of one core)")
+
+
+if __name__ == "__main__":
+    nsensors=int(sys.argv[1]) if len(sys.argv)>1 else 4
+    speed=float(sys.argv[2]) if len(sys.argv)>2 else 10.0
+    recording=sys.argv[3] if len(sys.argv)>3 else '../testdata/[1]/02'
+    asyncio.run(run(nsensors, speed, recording))
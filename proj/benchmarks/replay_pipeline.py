@@ -0,0 +1,48 @@
+""" End-to-end benchmark of the bleakheart acquisition path.
+
+A recording is replayed as fast as possible through blereplay, so frames
+travel through the PMD control point protocol, the notification handlers
+and the decoders of PolarMeasurementData and HeartRate into queues, as in
+the online scripts.
+
+Run from this directory:
+    python replay_pipeline.py [recording prefix]
+"""
+
+import sys
+import time
+import asyncio
+# Allow importing bleakheart from parent directory
+sys.path.append('../')
+from bleakheart import PolarMeasurementData, HeartRate
+from blereplay import replay_backend
+
+
+async def run(recording, ecg_array):
+    """ Replay the recording once; return (ECG frames, HR frames,
+    seconds) """
+    scanner, client_class=replay_backend(recording, speed=None)
+    device=await scanner.find_device_by_filter(
+        lambda dev, adv: dev.name and "polar" in dev.name.lower())
+    finished=asyncio.Event()
+    ecgqueue=asyncio.Queue()
+    hrqueue=asyncio.Queue()
+    async with client_class(device, disconnected_callback=
+                            lambda client: finished.set()) as client:
+        pmd=PolarMeasurementData(client, ecg_queue=ecgqueue,
+                                 ecg_array=ecg_array)
+        heartrate=HeartRate(client, queue=hrqueue, instant_rate=True)
+        start=time.perf_counter()
+        await pmd.start_streaming('ECG')
+        await heartrate.start_notify()
+        await finished.wait()
+        elapsed=time.perf_counter()-start
+    return ecgqueue.qsize(), hrqueue.qsize(), elapsed
+
+
+if __name__ == "__main__":
+    recording=sys.argv[1] if len(sys.argv)>1 else '../testdata/[1]/02'
+    for ecg_array in (False, True):
+        ecg, hr, elapsed=asyncio.run(run(recording, ecg_array))
+        print(f"ecg_array={ecg_array}: {ecg} ECG and {hr} HR frames "
+              f"in {elapsed*1000:.1f} ms ({(ecg+hr)/elapsed:.0f} frames/s)")
@@ -0,0 +1,85 @@
+""" Check of the gong and chime sequencing of SonificationEngine.
+
+Two windows are rendered on pyo's offline server, span seconds apart,
+and the triggers of the gong and chime players are logged with their
+time and (for the chime) amplitude. Each window must strike the gong
+once now and then after each RR value but the last (divided by 10), and
+ring the chime every 1.75 s for each R peak but the last, with the
+amplitude of that peak divided by 100; a new window cuts the sequence
+of the previous one short.
+
+Run from this directory:
+    python sonification_triggers.py
+"""
+
+import os
+import sys
+import tempfile
+# Allow importing from parent directory
+sys.path.append('../')
+from pyo import Server, Linseg, TrigFunc
+from sonification import SonificationEngine, play_windows
+
+SPAN=8.0
+WINDOWS=[({"QRS Durations": [0.1], "R Peaks": [50, 60, 70, 80]},
+          {"RR Intervals": [10, 20, 30, 40]}),
+         ({"QRS Durations": [0.1], "R Peaks": [10, 20, 30]},
+          {"RR Intervals": [20, 10, 40]})]
+# time resolution of the log: one processing block, with margin
+TOLERANCE=0.02
+
+
+def expected(windows, span):
+    """ Expected (time, amplitude) of the gong strikes and chime rings """
+    gong, chime=[], []
+    for index, (ecgdata, rrdata) in enumerate(windows):
+        start=index*span
+        end=start+span
+        time=start
+        for rr in rrdata["RR Intervals"][:-1]:
+            if time<end:
+                gong.append((time, None))
+            time+=rr/10
+        for ring, peak in enumerate(ecgdata["R Peaks"][:-1]):
+            if start+ring*1.75<end:
+                chime.append((start+ring*1.75, peak/100))
+    return gong, chime
+
+
+def render_log(windows, span):
+    """ Render windows offline; returns the logged gong and chime
+    triggers """
+    server=Server(audio='offline', nchnls=2).boot()
+    path=os.path.join(tempfile.mkdtemp(), 'check.wav')
+    duration=len(windows)*span
+    server.recordOptions(dur=duration, filename=path)
+    engine=SonificationEngine(server)
+    # a ramp that reads the current time, in seconds
+    clock=Linseg([(0, 0), (duration+1, duration+1)]).play()
+    gong, chime=[], []
+    logs=[TrigFunc(engine._gong_trig,
+                   lambda: gong.append((clock.get(), None))),
+          TrigFunc(engine._chime_trig,
+                   lambda: chime.append((clock.get(),
+                                         engine._chime_amp.get())))]
+    pattern=play_windows(engine, windows, span)
+    server.start()
+    server.shutdown()
+    os.remove(path)
+    return gong, chime
+
+
+def same(logged, wanted):
+    return len(logged)==len(wanted) and all(
+        abs(t-u)<=TOLERANCE and (a==None or abs(a-b)<1e-6)
+        for (t, a), (u, b) in zip(logged, wanted))
+
+
+if __name__ == "__main__":
+    gong, chime=render_log(WINDOWS, SPAN)
+    want_gong, want_chime=expected(WINDOWS, SPAN)
+    for name, logged, wanted in [('gong', gong, want_gong),
+                                 ('chime', chime, want_chime)]:
+        print(f"{name}: {[(round(t, 2), a) for t, a in logged]}")
+        assert same(logged, wanted), f"{name} expected {wanted}"
+    print("gong and chime follow the data of each window")
@@ -9,10 +9,16 @@ Copyright (C) Fabrizio Smeraldi - fabrizio@smeraldi.net, 2023
 __version__ = "0.1.0"
 
 import asyncio as aio
-from time import time_ns
-from collections import defaultdict
+import struct
+from time import time_ns, perf_counter_ns
+from collections import defaultdict, namedtuple, deque
 from bleak import BleakGATTCharacteristic, BleakClient
 from inspect import iscoroutinefunction
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed for array decoding
+    np=None
 
 
 class BatteryLevel:
@@ -34,6 +40,242 @@ class BatteryLevel:
 
 
 
+# A batch of coalesced frames, see FrameBatcher
+FrameBatch=namedtuple('FrameBatch',
+                      ['label', 'tstamps', 'samples', 'offsets', 'times'])
+
+
+class FrameBatcher:
+    """ Coalesces the frames passed to a callback or queue into batches,
+    delivered when max_frames frames have accumulated or interval seconds
+    after the first frame of the batch, whichever comes first. This
+    replaces one callback invocation (and, for coroutines, one scheduler
+    round trip) per frame with one per batch.
+
+    Batches are FrameBatch named tuples
+        (label, tstamps, samples, offsets, times)
+    where label is the DTYPE string of the frames, tstamps an int64 NumPy 
+    array with the time stamp of each frame, samples the concatenation of
+    the frame payloads as a NumPy array, and offsets an array with the 
+    index one past the last sample of each frame in samples. Heart rate
+    samples are rows of (hr, rr). times holds the time stamp of every 
+    sample when it is known (heart rate frames, or PMD frames decoded with
+    sample_times=True) and is None otherwise. The energy expenditure 
+    field of heart rate frames is not batched.
+    """
+
+    def __init__(self, callback, max_frames=None, interval=None):
+        """ Init the FrameBatcher object.
+
+        Args:
+
+        callback:   a function or coroutine function to which batches are 
+                    passed; coroutines are scheduled as tasks
+        max_frames: number of frames that triggers delivery of a batch
+        interval:   maximum time (in s) a frame is held before delivery
+        """
+        if np==None:
+            raise RuntimeError("Frame batching requires numpy")
+        if max_frames==None and interval==None:
+            raise RuntimeError("Batching needs max_frames or interval")
+        self._callback=callback
+        self._callback_is_coro=iscoroutinefunction(callback)
+        self.max_frames=max_frames
+        self.interval=interval
+        self._frames=[]
+        self._timer=None
+        self._tasks=set() # keeps pending callback tasks alive
+
+    def push(self, frame):
+        """ Add a frame to the current batch """
+        self._frames.append(frame)
+        if len(self._frames)==1 and self.interval!=None:
+            loop=aio.get_running_loop()
+            self._timer=loop.call_later(self.interval, self.flush)
+        if self.max_frames!=None and len(self._frames)>=self.max_frames:
+            self.flush()
+
+    def flush(self):
+        """ Deliver the current batch, if not empty """
+        if self._timer!=None:
+            self._timer.cancel()
+            self._timer=None
+        if not self._frames:
+            return
+        batch=self._make_batch(self._frames)
+        self._frames=[]
+        if self._callback_is_coro:
+            task=aio.ensure_future(self._callback(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._callback(batch)
+
+    @staticmethod
+    def _make_batch(frames):
+        """ Build a FrameBatch from a list of frames of the same type """
+        label=frames[0][0]
+        tstamps=np.fromiter((frame[1] for frame in frames), dtype=np.int64,
+                            count=len(frames))
+        if label=='HR':
+            rows=[]
+            times=[]
+            counts=[]
+            for _, tstamp, (hr, rr), _ in frames:
+                if isinstance(rr, list):
+                    # packed frame: the time stamp refers to the last beat
+                    t_est=tstamp-sum(rr)*1000000
+                    for r in rr:
+                        t_est+=r*1000000
+                        rows.append((hr, r))
+                        times.append(t_est)
+                    counts.append(len(rr))
+                else:
+                    rows.append((hr, rr))
+                    times.append(tstamp)
+                    counts.append(1)
+            samples=np.array(rows, dtype=np.int32).reshape(-1, 2)
+            times=np.array(times, dtype=np.int64)
+        else:
+            payloads=[np.asarray(frame[2]) for frame in frames]
+            samples=np.concatenate(payloads)
+            counts=[len(payload) for payload in payloads]
+            if all(len(frame)>3 for frame in frames):
+                times=np.concatenate([frame[3] for frame in frames])
+            else:
+                times=None
+        offsets=np.cumsum(counts, dtype=np.int64)
+        return FrameBatch(label, tstamps, samples, offsets, times)
+
+
+class Histogram:
+    """ Counts of non-negative integers (durations in ns) in power-of-two
+    buckets: bucket i holds the values that are i bits long, i.e. from
+    2**(i-1) to 2**i-1; the last bucket also holds all larger values. 
+    Recording a value costs a few integer operations. """
+
+    def __init__(self, buckets=40):
+        self.counts=[0]*buckets
+        self.count=0
+        self.total=0
+        self.max=0
+
+    def record(self, value):
+        """ Add a value to the histogram """
+        self.counts[min(value.bit_length(), len(self.counts)-1)]+=1
+        self.count+=1
+        self.total+=value
+        if value>self.max:
+            self.max=value
+
+    def percentile(self, q):
+        """ Upper bound of the bucket holding the q-th percentile 
+        (0<q<=100), capped at the largest value; None if empty """
+        rank=q*self.count/100
+        cumulative=0
+        for bucket, count in enumerate(self.counts):
+            cumulative+=count
+            if count>0 and cumulative>=rank:
+                return min((1<<bucket)-1, self.max)
+        return None
+
+    def summary(self):
+        """ A dictionary with count, mean, median, 99th percentile and 
+        maximum """
+        return {'count': self.count,
+                'mean': self.total/self.count if self.count else None,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'max': self.max}
+
+
+class Instrumentation:
+    """ Opt-in latency measurements for HeartRate and PolarMeasurementData
+    (pass instrument= to either; one object can serve both). For each 
+    frame label ('HR', 'ECG', ...) it keeps histograms, in ns, of
+
+        decode:     time spent in the notification handler before the
+                    frame is passed on (decoding, time stamp conversion)
+        callback:   time spent in the callback or queue put
+        queue_wait: time from the handler passing the frame on to the 
+                    consumer taking it off the queue
+
+    The consumer must call mark_dequeued(label) for every frame it takes
+    off a queue; frames are matched in FIFO order. A steadily growing 
+    backlog (frames passed on but not yet dequeued) or queue_wait means
+    that the consumer is falling behind the sensor. queue_wait is not
+    meaningful when frames go to a callback or are batched. """
+
+    stages=['decode', 'callback', 'queue_wait']
+
+    def __init__(self, buckets=40, max_pending=4096):
+        """ Init the Instrumentation object.
+
+        Args:
+
+        buckets: number of buckets of each Histogram
+        max_pending: number of enqueue times remembered for each label; 
+                older ones are forgotten if the consumer does not call 
+                mark_dequeued
+        """
+        self.buckets=buckets
+        self.histograms={}
+        self._pending=defaultdict(lambda: deque(maxlen=max_pending))
+
+    def record(self, label, stage, value):
+        """ Add a duration (in ns) to the histogram of label and stage """
+        try:
+            self.histograms[(label, stage)].record(value)
+        except KeyError:
+            self.histograms[(label, stage)]=Histogram(self.buckets)
+            self.histograms[(label, stage)].record(value)
+
+    def enqueued(self, label):
+        """ Called by the handlers when a frame is passed on """
+        self._pending[label].append(perf_counter_ns())
+
+    def mark_dequeued(self, label):
+        """ Called by the consumer when it takes a frame off a queue. 
+        Returns the time the frame waited, in ns (None if no frame with 
+        that label was pending) """
+        try:
+            wait=perf_counter_ns()-self._pending[label].popleft()
+        except IndexError:
+            return None
+        self.record(label, 'queue_wait', wait)
+        return wait
+
+    def backlog(self, label):
+        """ Number of frames with label passed on but not yet dequeued """
+        return len(self._pending[label])
+
+    def snapshot(self, reset=False):
+        """ Current statistics as a dictionary {label: {stage: summary}},
+        see Histogram.summary, with the backlog of each label under 
+        'backlog'. If reset is True, the histograms start afresh. """
+        stats=defaultdict(dict)
+        for (label, stage), histogram in self.histograms.items():
+            stats[label][stage]=histogram.summary()
+        for label, pending in self._pending.items():
+            stats[label]['backlog']=len(pending)
+        if reset:
+            self.histograms={}
+        return dict(stats)
+
+    def report(self):
+        """ The snapshot as text, one line per label, times in us """
+        lines=[]
+        for label, stats in sorted(self.snapshot().items()):
+            fields=[f"{label}: backlog {stats.get('backlog', 0)}"]
+            for stage in self.stages:
+                if stage in stats:
+                    summary=stats[stage]
+                    fields.append(f"{stage} p50 {summary['p50']/1000:.0f} "
+                                  f"p99 {summary['p99']/1000:.0f} "
+                                  f"max {summary['max']/1000:.0f} us")
+            lines.append(', '.join(fields))
+        return '\n'.join(lines)
+
+
 class HeartRate:
     """ Access heart rate service as specified by the BLE SIG - this
     should work with all devices following the specification. Frames 
@@ -60,11 +302,15 @@ class HeartRate:
     """
     
     CHARACTERISTIC="00002a37-0000-1000-8000-00805f9b34fb"
+    # frame layouts by flags byte and frame length, compiled on first use
+    _layouts={}
 
     def __init__(self, client: BleakClient, queue: aio.Queue=None,
                  callback=None, contact_callback=None,
                  contact_lost_callback=None,
-                 instant_rate=False, unpack=True):
+                 instant_rate=False, unpack=True,
+                 batch_frames=None, batch_interval=None, recorder=None,
+                 instrument=None):
         """
         Init the HeartRate object.
 
@@ -87,6 +333,15 @@ class HeartRate:
         unpack: if True, data in sensor frames is  unpacked and processed as 
                 individual heartbeats. Only works if RR intervals are 
                 supported
+        batch_frames, batch_interval: if either is given, frames are 
+                coalesced and delivered as FrameBatch tuples every 
+                batch_frames frames (heartbeats, if unpacking) or 
+                batch_interval seconds; see FrameBatcher
+        recorder: a framelog.FrameRecorder (or any object with a 
+                record(source, tstamp, data) method) to which the raw
+                frames are appended as they arrive
+        instrument: an Instrumentation object that records the latency
+                of the handler, the callback and the queue
 
         Attributes:
 
@@ -111,7 +366,14 @@ class HeartRate:
             raise RuntimeError("No queue or callback given for HR signal")
         # _callback is passed sensor frames by handler
         self._callback=queue.put_nowait if queue!=None else callback
+        self._batcher=None
+        if batch_frames!=None or batch_interval!=None:
+            self._batcher=FrameBatcher(self._callback, batch_frames,
+                                       batch_interval)
+            self._callback=self._batcher.push
         self._callback_is_coro=iscoroutinefunction(self._callback)
+        self._recorder=recorder
+        self._instrument=instrument
         # contact detection
         self.good_contact=aio.Event()
         self.lost_contact=aio.Event()
@@ -127,48 +389,58 @@ class HeartRate:
                                      if self._lost_callback!=None else None)
 
 
+    @staticmethod
+    def _compile_layout(flags, size):
+        """ Compile the decoding of frames of size bytes with the given 
+        flags byte. Returns a tuple (layout, energy, rr, 
+        contact_detection, contact) where layout is a struct unpacking, 
+        after the flags byte, the heart rate, the energy expenditure if 
+        present and every RR interval; rr is the index of the first RR 
+        interval in the unpacked values, or None if there are none; the 
+        other entries are the flag bits. """
+        fmt='<'
+        fmt+='B' if (flags & 1)==0 else 'H' # bit 0: uint8 or uint16 hr
+        energy_expenditure=(flags & 8)>0 # bit 3
+        if energy_expenditure:
+            fmt+='H'
+        rr=None
+        if flags & 16: # bit 4: rr intervals present
+            rr=len(fmt)-1
+            fmt+='H'*max((size-1-struct.calcsize(fmt))//2, 0)
+        return (struct.Struct(fmt), energy_expenditure, rr,
+                (flags & 4)>0,  # bit 2: contact detection supported
+                (flags & 2)>0)  # bit 1: good contact
+
     def _decode(self, data: bytearray):
         """
         See www.bluetooth.com/specifications/specs/heart-rate-service-1-0/ 
-        for the structure of the frame.
+        for the structure of the frame. The flags byte and the length of 
+        the frame select a layout, compiled on first use, which unpacks 
+        all the fields with a single struct call.
         NOTE: Polar H10 does not support contact bit or energy expenditure,
         so these features are untested
         """
         # the first byte contains flags
-        flags = data[0]
-        payload={}
-
-        # format for hr: 1 or 2 bits, little endian
-        uint8_format = (flags & 1) == 0  # bit 0, can change
-        energy_expenditure = (flags & 8)>0 # bit 3, can change
-        rr_intervals = (flags & 16) >0  # bit 4, can change
-        
-        self.contact_detection= (flags & 4) > 0 # bit 2, static
+        try:
+            layout=self._layouts[data[0], len(data)]
+        except KeyError:
+            layout=self._compile_layout(data[0], len(data))
+            self._layouts[data[0], len(data)]=layout
+        (fields, energy_expenditure, rr_intervals,
+         self.contact_detection, contact)=layout
+        values=fields.unpack_from(data, 1)
+        payload={'hr': values[0]}
         if self.contact_detection:
             # good contact if bit is set
-            payload['contact']= (flags & 2) >0 # bit 1, can change
-            
-        if uint8_format:
-            payload['hr'] = data[1]
-            offset=2
-        else:
-            payload['hr'] = int.from_bytes(data[1:3], 'little', signed=False)
-            offset=3
+            payload['contact']=contact
         if energy_expenditure:
-            nrg = int.from_bytes(data[offset:offset+2], 'little', signed=False)
-            offset += 2
-            payload['nrg']=nrg
-
-        if rr_intervals:
-            payload['rr']=[]
-            for i in range(offset, len(data), 2):
-                rr = int.from_bytes(data[offset:offset+2],
-                                    'little', signed=False)
-                # Polar H7, H9, and H10 record RR intervals
-                # in 1024-th parts of a second. Convert this
-                # to milliseconds.
-                rr = round(rr * 1000 / 1024)
-                payload['rr'].append(rr)
+            payload['nrg']=values[1]
+        if rr_intervals!=None:
+            # Polar H7, H9, and H10 record RR intervals
+            # in 1024-th parts of a second. Convert this
+            # to milliseconds.
+            payload['rr']=[round(rr * 1000 / 1024) for rr in
+                           values[rr_intervals:]]
         return payload
 
     
@@ -176,6 +448,11 @@ class HeartRate:
                        data: bytearray):
         """ Callback handler for notifications """
         tstamp=time_ns()
+        if self._recorder!=None:
+            self._recorder.record('HR', tstamp, data)
+        instrument=self._instrument
+        if instrument!=None:
+            start=perf_counter_ns()
         payload=self._decode(data)
         # contact detection supported
         if self.contact_detection:
@@ -200,24 +477,31 @@ class HeartRate:
 
         avghr=payload['hr']
         rrlist=payload.get('rr', [])
-        energy=payload.get('ee', None)
+        energy=payload.get('nrg', None)
         if not self.unpack:
-            if self._callback_is_coro:
-                await self._callback(('HR', tstamp, (avghr, rrlist), energy))
-            else:
-                self._callback(('HR', tstamp, (avghr, rrlist), energy))
+            frames=[('HR', tstamp, (avghr, rrlist), energy)]
         else:
             # unpack each individual heartbeat
             if len(rrlist)==0:
                 return
+            frames=[]
             t_est=tstamp-sum(rrlist)*1000000 # nanoseconds
             for rr in rrlist:
                 t_est+=rr * 1000000 # nanoseconds
                 hr=round(60000.0/rr) if self.instant_rate else avghr
-                if self._callback_is_coro:
-                    await self._callback(('HR', t_est, (hr, rr), energy))
-                else:
-                    self._callback(('HR', t_est, (hr, rr), energy))
+                frames.append(('HR', t_est, (hr, rr), energy))
+        if instrument!=None:
+            decoded=perf_counter_ns()
+            instrument.record('HR', 'decode', decoded-start)
+        for frame in frames:
+            if instrument!=None:
+                instrument.enqueued('HR')
+            if self._callback_is_coro:
+                await self._callback(frame)
+            else:
+                self._callback(frame)
+        if instrument!=None:
+            instrument.record('HR', 'callback', perf_counter_ns()-decoded)
 
 
     async def start_notify(self, filter_nocontact=False):
@@ -236,10 +520,128 @@ class HeartRate:
     async def stop_notify(self):
         """ Stop heart rate notifications """
         await self.client.stop_notify(HeartRate.CHARACTERISTIC)
+        if self._batcher!=None:
+            self._batcher.flush()
         self.good_contact.clear()
         self.lost_contact.clear()
 
-        
+
+
+class ClockModel:
+    """ Online estimate of the linear mapping between the sensor clock and
+    the host clock, host = offset + slope * sensor, fitted by exponentially
+    weighted least squares over (sensor time stamp, host arrival time)
+    pairs. The weights let the fit follow slow drift over long sessions.
+    Host arrival times are delayed by a variable transmission latency;
+    pairs whose residual is far above the typical residual (late
+    notifications) are rejected as outliers. If too many consecutive
+    pairs are rejected the clocks are assumed to have jumped, and the
+    model restarts from the last of them.
+    """
+
+    def __init__(self, forgetting=0.999, outlier_factor=5.0,
+                 min_tolerance=2000000, warmup=8, max_rejected=16,
+                 min_span=30):
+        """ Init the ClockModel object.
+
+        Args:
+
+        forgetting: weight decay applied at each update; 1/(1-forgetting)
+                is roughly the number of recent pairs the fit follows
+        outlier_factor: pairs with a residual larger than outlier_factor
+                times the mean absolute residual are rejected
+        min_tolerance: residuals below this value (in ns) are never 
+                rejected
+        warmup: number of pairs accepted unconditionally at start
+        max_rejected: number of consecutive rejections after which the 
+                model is reset
+        min_span: sensor time (in s) the pairs must cover before the slope
+                is estimated; until then the clocks are assumed to run at
+                the same rate, which is far more accurate than a slope
+                fitted over a few noisy seconds
+        """
+        self.forgetting=forgetting
+        self.outlier_factor=outlier_factor
+        self.min_tolerance=min_tolerance*1e-9
+        self.warmup=warmup
+        self.max_rejected=max_rejected
+        self.min_span=min_span
+        self.reset()
+
+    def reset(self):
+        """ Discard the current fit """
+        self._origin=None # (sensor, host) time stamps of the first pair
+        self._weight=0.0
+        self._mean_x=0.0
+        self._mean_y=0.0
+        self._cxx=0.0
+        self._cxy=0.0
+        self._residual=0.0 # mean absolute residual
+        self._span=0.0 # sensor time covered by accepted pairs
+        self.accepted=0
+        self.rejected=0
+        self._consecutive_rejected=0
+
+    @property
+    def slope(self):
+        """ Estimated rate of the host clock relative to the sensor 
+        clock (1.0 until the pairs span min_span seconds) """
+        if self._span<self.min_span or self._cxx<=0:
+            return 1.0
+        return self._cxy/self._cxx
+
+    def _predict(self, x):
+        """ Host time (s, relative to origin) for sensor time x (s, 
+        relative to origin) """
+        return self._mean_y+self.slope*(x-self._mean_x)
+
+    def update(self, sensor_ts, host_ts):
+        """ Add a (sensor, host) pair of time stamps in ns. Returns False
+        if the pair was rejected as an outlier. """
+        if self._origin==None:
+            self._origin=(sensor_ts, host_ts)
+        x=(sensor_ts-self._origin[0])*1e-9
+        y=(host_ts-self._origin[1])*1e-9
+        if self.accepted>=self.warmup:
+            residual=abs(y-self._predict(x))
+            tolerance=max(self.outlier_factor*self._residual,
+                          self.min_tolerance)
+            if residual>tolerance:
+                self.rejected+=1
+                self._consecutive_rejected+=1
+                if self._consecutive_rejected>=self.max_rejected:
+                    # restart the fit from this pair
+                    self.reset()
+                    self.update(sensor_ts, host_ts)
+                return False
+            self._residual+=(1-self.forgetting)*(residual-self._residual)
+        elif self.accepted>=2:
+            residual=abs(y-self._predict(x))
+            self._residual+=(residual-self._residual)/self.accepted
+        self._consecutive_rejected=0
+        self.accepted+=1
+        self._span=max(self._span, x)
+        # exponentially weighted running means and co-moments
+        self._weight=self.forgetting*self._weight+1.0
+        dx=x-self._mean_x
+        self._mean_x+=dx/self._weight
+        self._mean_y+=(y-self._mean_y)/self._weight
+        self._cxx=self.forgetting*self._cxx+dx*(x-self._mean_x)
+        self._cxy=self.forgetting*self._cxy+dx*(y-self._mean_y)
+        return True
+
+    def to_host(self, sensor_ts):
+        """ Convert sensor time stamps in ns (an int or a NumPy array) to
+        host time in ns """
+        if self._origin==None:
+            raise RuntimeError("Clock model has no data")
+        x=(sensor_ts-self._origin[0])*1e-9
+        y=self._predict(x)*1e9
+        if np!=None and isinstance(y, np.ndarray):
+            return self._origin[1]+np.rint(y).astype(np.int64)
+        return self._origin[1]+round(y)
+
+
 class PolarMeasurementData:
     """ Access measurements provided through the Polar Measurement Data
     interface: Electrocardiogram, Acceleration, Photoplethysmography, 
@@ -249,15 +651,48 @@ class PolarMeasurementData:
     tstamp is the sensor time stamp in ns, and payload is the requested 
     measurement data. The time stamp is converted to standard epoch time 
     using a single offset computed at the time the first data frame is 
-    received. ECG and acceleration data (as supported by Polar H10) are 
-    decoded; other measurement data are streamed, but they are returned 
-    as raw bytearray.
+    received. ECG and acceleration data (as supported by Polar H10), and 
+    PPG and PPI data (as supported by Polar optical sensors such as the 
+    Verity Sense and OH1) are decoded; other measurement data are 
+    streamed, but they are returned as raw bytearray.
 
     Acceleration samples are returned as tuples of values along the three
     axes (x,y,z), in milliG; ECG is returned as a list of integer samples in 
     microVolt (on the H10, ECG  sampling frequency is 130Hz and encoding 
     is 14 bit). In either case, the time stamp refers to the last sample 
     of the list constituting the payload.
+
+    If ecg_array is True, ECG payloads are instead returned as int32 
+    NumPy arrays decoded in a single vectorized step; this avoids building 
+    a Python int for each sample and lets consumers skip any conversion 
+    of the payload before processing. Likewise, if acc_array is True, 
+    acceleration payloads are returned as (n, 3) int16 arrays with one row
+    per sample and columns x, y, z.
+
+    PPG samples have four channels (three PPG and ambient light): they 
+    are returned as lists of tuples, or as (n, 4) int32 arrays if 
+    ppg_array is True. PPI payloads are lists of tuples
+        (hr, ppi, error, blocker, contact)
+    one per heartbeat, with the heart rate in bpm, the peak-to-peak 
+    interval and its estimated error in ms, a flag set when the interval 
+    is unreliable (e.g. because of movement) and the skin contact status
+    (None if not supported). PPI frames carry no sensor time stamp, so 
+    they are time stamped on arrival.
+
+    Delta-compressed frames (frame types with bit 7 set, see delta_frames)
+    are decoded for ECG, ACC and PPG, into the same list or array format 
+    as the uncompressed frames of that measurement. Compressed samples 
+    are assumed to use the resolution requested in start_streaming 
+    (default_resolution if none was given).
+
+    If drift_correction is True, sensor time stamps are converted to host
+    time through a ClockModel that is updated with every frame, rather 
+    than through the single offset. If sample_times is True, decoded ECG, 
+    ACC and PPG frames carry a fourth element: an int64 NumPy array with the
+    estimated time stamp of every sample, 
+        (DTYPE, tstamp, payload, times)
+    where sample spacing is measured on the sensor clock from consecutive
+    frames (falling back on the nominal sampling rate). 
     """
     # BLE characteristics
     PMDCTRLPOINT="FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"
@@ -275,6 +710,18 @@ class PolarMeasurementData:
     default_settings={'ECG': {'SAMPLE_RATE': 130, 'RESOLUTION': 14},
                       'ACC': {'SAMPLE_RATE': 200, 'RESOLUTION': 16,
                               'RANGE': 2 }}
+    # delta-compressed frame types: number of channels of each sample
+    delta_frames={('ECG', 0x80): 1, ('ACC', 0x80): 3, ('PPG', 0x80): 4}
+    # sample resolution in bit of compressed frames, if not set when
+    # streaming was started
+    default_resolution={'ECG': 14, 'ACC': 16, 'PPG': 22}
+    # one PPI sample: hr, interval, error estimate, flags
+    _ppi_layout=struct.Struct('<BHHB')
+    # bit weights of the deltas in compressed frames; filled in below the
+    # class
+    _delta_weights=None
+    # delta widths that NumPy reads directly, as little-endian integers
+    _delta_dtypes={8: '<i1', 16: '<i2', 32: '<i4'}
     # these are Polar sensor errors; bleakheart errors will use negative
     # error codes
     error_msgs=['SUCCESS', 'INVALID OP CODE', 'INVALID MEASUREMENT TYPE',
@@ -286,7 +733,13 @@ class PolarMeasurementData:
 
     def __init__(self, client: BleakClient,
                  ecg_queue:aio.Queue=None, acc_queue:aio.Queue=None,
-                 raw_queue:aio.Queue=None, callback=None):
+                 raw_queue:aio.Queue=None, callback=None,
+                 ecg_array=False, acc_array=False,
+                 ppg_queue:aio.Queue=None, ppg_array=False,
+                 ppi_queue:aio.Queue=None,
+                 drift_correction=False, sample_times=False,
+                 batch_frames=None, batch_interval=None, recorder=None,
+                 instrument=None):
         """" Init the PolarMeasurementData object.
 
         Args:
@@ -301,24 +754,91 @@ class PolarMeasurementData:
                    passed to the callback
         callback:  a function or coroutine function to which all measurement
                    data not pushed onto a queue is passed. 
+        ecg_array: if True, ECG payloads are int32 NumPy arrays rather than
+                   lists of integers (requires numpy)
+        acc_array: if True, ACC payloads are (n, 3) int16 NumPy arrays 
+                   rather than lists of (x,y,z) tuples (requires numpy)
+        ppg_queue: an asyncio queue onto which decoded PPG data is pushed;
+                   if unspecified, data will be passed to callback
+        ppg_array: if True, PPG payloads are (n, 4) int32 NumPy arrays
+                   rather than lists of tuples (requires numpy)
+        ppi_queue: an asyncio queue onto which decoded PPI data is pushed;
+                   if unspecified, data will be passed to callback
+        drift_correction: if True, fit a ClockModel to map sensor time 
+                   stamps to host time. The model is available as the
+                   clock attribute
+        sample_times: if True, append an array of per-sample time stamps
+                   to decoded ECG, ACC and PPG frames (requires numpy)
+        batch_frames, batch_interval: if either is given, ECG, ACC and
+                   PPG frames are coalesced and delivered as FrameBatch tuples
+                   every batch_frames frames or batch_interval seconds;
+                   see FrameBatcher. Raw frames are not batched
+        recorder:  a framelog.FrameRecorder (or any object with a 
+                   record(source, tstamp, data) method) to which the raw
+                   data frames are appended as they arrive
+        instrument: an Instrumentation object that records the latency
+                   of the handler, the callbacks and the queues
         """
+        if (ecg_array or acc_array or ppg_array or sample_times) and np==None:
+            raise RuntimeError("ecg_array, acc_array, ppg_array and "
+                               "sample_times require numpy")
         self.client=client
         self.ecg_queue=ecg_queue
         self.acc_queue=acc_queue
         self.raw_queue=raw_queue
+        self.ppg_queue=ppg_queue
+        self.ppi_queue=ppi_queue
         if callback==None:
             callback=self._no_callback
         self._ecg_callback=ecg_queue.put_nowait if ecg_queue!=None else callback
         self._acc_callback=acc_queue.put_nowait if acc_queue!=None else callback
         self._raw_callback=raw_queue.put_nowait if raw_queue!=None else callback
+        self._ppg_callback=ppg_queue.put_nowait if ppg_queue!=None else callback
+        self._ppi_callback=ppi_queue.put_nowait if ppi_queue!=None else callback
+        # one batcher for each measurement, since batches are homogeneous
+        self._batchers={}
+        if batch_frames!=None or batch_interval!=None:
+            if self._ecg_callback!=self._no_callback:
+                self._batchers['ECG']=FrameBatcher(self._ecg_callback,
+                                                   batch_frames, 
+                                                   batch_interval)
+                self._ecg_callback=self._batchers['ECG'].push
+            if self._acc_callback!=self._no_callback:
+                self._batchers['ACC']=FrameBatcher(self._acc_callback,
+                                                   batch_frames,
+                                                   batch_interval)
+                self._acc_callback=self._batchers['ACC'].push
+            if self._ppg_callback!=self._no_callback:
+                self._batchers['PPG']=FrameBatcher(self._ppg_callback,
+                                                   batch_frames,
+                                                   batch_interval)
+                self._ppg_callback=self._batchers['PPG'].push
         self._ecg_callback_is_coro=iscoroutinefunction(self._ecg_callback)
         self._acc_callback_is_coro=iscoroutinefunction(self._acc_callback)
         self._raw_callback_is_coro=iscoroutinefunction(self._raw_callback)
+        self._ppg_callback_is_coro=iscoroutinefunction(self._ppg_callback)
+        self._ppi_callback_is_coro=iscoroutinefunction(self._ppi_callback)
+        self._decode_ecg=(self._decode_ecg_array if ecg_array
+                          else self._decode_ecg_data)
+        self._decode_acc=(self._decode_acc_array if acc_array
+                          else self._decode_acc_data)
+        self._decode_ppg=(self._decode_ppg_array if ppg_array
+                          else self._decode_ppg_data)
         self._ctrl_lock=aio.Lock()
         self._ctrl_recv=aio.Event() # ctrl response ready
         self._ctrl_response=None
         self._notifications_started=False
         self._time_offset=None
+        self.clock=ClockModel() if drift_correction else None
+        self.sample_times=sample_times
+        # sensor time stamp of the last frame and nominal sampling rate, 
+        # by measurement; used to space samples within a frame
+        self._last_sensor_ts={}
+        self._sample_rate={}
+        # resolution requested for each measurement, for compressed frames
+        self._resolution={}
+        self._recorder=recorder
+        self._instrument=instrument
 
     def _no_callback(self, payload):
         """ Used to raise an error if no queue or callback has been 
@@ -376,38 +896,96 @@ class PolarMeasurementData:
         relevant queue or calls/awaits the callback. Data are formatted
         as tuples: (MEASR, timestamp, payload) where MEASR is a string
         identifying the measurement, followed by the sensor timestamp and 
-        the list of samples (for measurements other than ECG or ACC, the 
-        raw dataframe is returned as the payload).
+        the list of samples (for measurements other than ECG, ACC, PPG and
+        PPI, the raw dataframe is returned as the payload).
         """
+        host_ts=time_ns()
+        if self._recorder!=None:
+            self._recorder.record('PMD', host_ts, data)
+        instrument=self._instrument
+        if instrument!=None:
+            start=perf_counter_ns()
         meas=self.measurement_types[data[0]]
-        timestamp=int.from_bytes(data[1:9], 'little', signed=False)
+        sensor_ts=int.from_bytes(data[1:9], 'little', signed=False)
         frametype=data[9]
-        try:
-            timestamp+=self._time_offset
-        except TypeError:
-            self._time_offset=time_ns()-timestamp
-            timestamp+=self._time_offset
+        if sensor_ts==0:
+            # PPI frames are not time stamped by the sensor
+            timestamp=host_ts
+        elif self.clock!=None:
+            self.clock.update(sensor_ts, host_ts)
+            timestamp=self.clock.to_host(sensor_ts)
+        else:
+            try:
+                timestamp=sensor_ts+self._time_offset
+            except TypeError:
+                self._time_offset=host_ts-sensor_ts
+                timestamp=sensor_ts+self._time_offset
         
         if meas=='ECG':
-            payload=self._decode_ecg_data(data)
-            if self._ecg_callback_is_coro:
-                await self._ecg_callback(('ECG', timestamp, payload))
-            else:
-                self._ecg_callback(('ECG', timestamp, payload))
-        elif (meas=='ACC') and (frametype==1):
-            payload=self._decode_acc_data(data)
-            if self._acc_callback_is_coro:
-                await self._acc_callback(('ACC', timestamp, payload))
-            else:
-                self._acc_callback(('ACC', timestamp, payload))
+            payload=self._decode_ecg(data)
+            callback, is_coro=self._ecg_callback, self._ecg_callback_is_coro
+            timed=True
+        elif (meas=='ACC') and (frametype==1 or 
+                                (meas, frametype) in self.delta_frames):
+            payload=self._decode_acc(data)
+            callback, is_coro=self._acc_callback, self._acc_callback_is_coro
+            timed=True
+        elif (meas=='PPG') and (frametype==0 or 
+                                (meas, frametype) in self.delta_frames):
+            payload=self._decode_ppg(data)
+            callback, is_coro=self._ppg_callback, self._ppg_callback_is_coro
+            timed=True
+        elif (meas=='PPI') and (frametype==0):
+            payload=self._decode_ppi_data(data)
+            callback, is_coro=self._ppi_callback, self._ppi_callback_is_coro
+            timed=False
         else:
             # send raw data to queue or callback
-            if self._raw_callback_is_coro:
-                await self._raw_callback((meas, timestamp, data))
-            else:
-                self._raw_callback((meas, timestamp, data))
-        
-    
+            payload=data
+            callback, is_coro=self._raw_callback, self._raw_callback_is_coro
+            # the payload is a byte string, not samples
+            timed=False
+        frame=(meas, timestamp, payload)
+        if self.sample_times and timed:
+            frame+=(self._sample_times(meas, sensor_ts, len(payload)),)
+        if instrument!=None:
+            decoded=perf_counter_ns()
+            instrument.record(meas, 'decode', decoded-start)
+            instrument.enqueued(meas)
+        if is_coro:
+            await callback(frame)
+        else:
+            callback(frame)
+        if instrument!=None:
+            instrument.record(meas, 'callback', perf_counter_ns()-decoded)
+
+    def _sample_times(self, meas, sensor_ts, nsamples):
+        """ Estimate the host time stamp of each sample in a frame.
+
+        Args:
+            meas: the measurement type of the frame
+            sensor_ts: the sensor time stamp of the frame, which refers to
+                  its last sample
+            nsamples: number of samples in the frame
+        Returns:
+            An int64 NumPy array of time stamps in ns
+        """
+        rate=self._sample_rate.get(meas)
+        nominal=1e9/rate if rate else None
+        period=nominal
+        last=self._last_sensor_ts.get(meas)
+        self._last_sensor_ts[meas]=sensor_ts
+        if last!=None and nsamples>0 and sensor_ts>last:
+            measured=(sensor_ts-last)/nsamples
+            # a gap in the stream makes the measured spacing meaningless
+            if nominal==None or abs(measured-nominal)<0.1*nominal:
+                period=measured
+        steps=np.arange(nsamples-1, -1, -1, dtype=np.int64)
+        sensor_times=sensor_ts-np.rint(steps*(period or 0)).astype(np.int64)
+        if self.clock!=None:
+            return self.clock.to_host(sensor_times)
+        return sensor_times+self._time_offset
+
     def _decode_ecg_data(self, data):
         """ Decodes ECG data frames from the device.
 
@@ -417,6 +995,8 @@ class PolarMeasurementData:
         Returns:
             A list of ECG values in microvolt, as integers
         """
+        if data[9]==0x80:
+            return [sample[0] for sample in self._decode_delta_data(data)]
         if data[9]!=0x00:
             raise ValueError("Invalid ECG frame type")
         if (len(data)-10)%3!=0:
@@ -429,18 +1009,51 @@ class PolarMeasurementData:
             microvolt.append(muv)
         return microvolt
 
+    def _decode_ecg_array(self, data):
+        """ Vectorized version of _decode_ecg_data.
+
+        Args: 
+            data: the raw ECG frame from the device
+        Returns:
+            An int32 NumPy array of ECG values in microvolt
+        """
+        if data[9]==0x80:
+            return self._decode_delta_array(data).reshape(-1)
+        if data[9]!=0x00:
+            raise ValueError("Invalid ECG frame type")
+        if (len(data)-10)%3!=0:
+            raise ValueError("Bad ECG data frame length")
+        return self._int24_array(data)
+
+    @staticmethod
+    def _int24_array(data):
+        """ The payload of a frame as an int32 NumPy array, decoded from
+        3-byte little-endian signed integers """
+        # view the payload in place as rows of 3 bytes; no copy is made
+        samples=np.frombuffer(data, dtype=np.uint8,
+                              offset=10).reshape(-1, 3)
+        # place each sample in the top 3 bytes of a little-endian int32,
+        # then shift right: the arithmetic shift sign-extends the value
+        words=np.zeros((len(samples), 4), dtype=np.uint8)
+        words[:, 1:]=samples
+        values=words.view('<i4').reshape(-1)
+        values>>=8
+        return values
+
     def _decode_acc_data(self, data):
         """ Decode acceleration data frame type 0x01 (x,y,z, 16 bit signed 
         int, unis: mG); this is the type of frame returned by the H10 strap
 
         Args:
-            data: the raw ACC frame from the device. Only frame type 0x01 is 
-            supported
+            data: the raw ACC frame from the device, of type 0x01 or 
+            compressed type 0x80
         Returns:
             A list of tuples of the form (x,y,z) where x, y, and z are 
             integers measuring the acceleration along the three axes
             in milliG.
         """
+        if data[9]==0x80:
+            return self._decode_delta_data(data)
         if data[9]!=0x01:
             raise ValueError(f"Unsupported ACC frame type {data[9]:02x}")
         if (len(data)-10)%6!=0:
@@ -452,6 +1065,199 @@ class PolarMeasurementData:
             z=int.from_bytes(data[offset+4:offset+6], 'little', signed=True)
             milli_g.append((x,y,z))
         return milli_g
+
+    def _decode_acc_array(self, data):
+        """ Vectorized version of _decode_acc_data.
+
+        Args:
+            data: the raw ACC frame from the device, of type 0x01 or 
+            compressed type 0x80
+        Returns:
+            A C-contiguous (n, 3) int16 NumPy array with the acceleration
+            along the x, y and z axes in milliG. For frames of type 0x01 
+            the array is a view on the frame, so no sample data is copied.
+        """
+        if data[9]==0x80:
+            milli_g=self._decode_delta_array(data)
+            if self._resolution.get('ACC', 16)<=16:
+                milli_g=milli_g.astype(np.int16)
+            return milli_g
+        if data[9]!=0x01:
+            raise ValueError(f"Unsupported ACC frame type {data[9]:02x}")
+        if (len(data)-10)%6!=0:
+            raise ValueError("Bad ACC data frame length")
+        milli_g=np.frombuffer(data, dtype='<i2', offset=10)
+        return milli_g.reshape(-1, 3)
+
+    def _decode_ppg_data(self, data):
+        """ Decode PPG frames of type 0x00 (four channels of 3-byte
+        little-endian signed integers) or compressed type 0x80, as sent by
+        Polar optical sensors.
+
+        Args:
+            data: the raw PPG frame from the device
+        Returns:
+            A list of tuples (ppg0, ppg1, ppg2, ambient), one per sample
+        """
+        if data[9]==0x80:
+            return self._decode_delta_data(data)
+        if data[9]!=0x00:
+            raise ValueError(f"Unsupported PPG frame type {data[9]:02x}")
+        if (len(data)-10)%12!=0:
+            raise ValueError("Bad PPG data frame length")
+        samples=[]
+        for offset in range(10, len(data), 12):
+            samples.append(tuple(int.from_bytes(data[pos:pos+3], 'little',
+                                                signed=True)
+                                 for pos in range(offset, offset+12, 3)))
+        return samples
+
+    def _decode_ppg_array(self, data):
+        """ Vectorized version of _decode_ppg_data.
+
+        Args:
+            data: the raw PPG frame from the device
+        Returns:
+            An (n, 4) int32 NumPy array, with columns ppg0, ppg1, ppg2 and
+            ambient
+        """
+        if data[9]==0x80:
+            return self._decode_delta_array(data)
+        if data[9]!=0x00:
+            raise ValueError(f"Unsupported PPG frame type {data[9]:02x}")
+        if (len(data)-10)%12!=0:
+            raise ValueError("Bad PPG data frame length")
+        return self._int24_array(data).reshape(-1, 4)
+
+    def _decode_ppi_data(self, data):
+        """ Decode PPI frames of type 0x00, as sent by Polar optical 
+        sensors. PPI frames hold a few beats, so there is no vectorized 
+        version.
+
+        Args:
+            data: the raw PPI frame from the device; each beat takes 6 
+            bytes: hr (uint8), interval and error estimate (uint16, in ms) 
+            and flags (bit 0: blocker, bit 1: skin contact, bit 2: skin 
+            contact supported)
+        Returns:
+            A list of tuples (hr, ppi, error, blocker, contact), one per 
+            beat
+        """
+        if data[9]!=0x00:
+            raise ValueError(f"Unsupported PPI frame type {data[9]:02x}")
+        if (len(data)-10)%6!=0:
+            raise ValueError("Bad PPI data frame length")
+        beats=[]
+        for hr, ppi, error, flags in self._ppi_layout.iter_unpack(
+                memoryview(data)[10:]):
+            contact=(flags & 2)>0 if (flags & 4) else None
+            beats.append((hr, ppi, error, (flags & 1)>0, contact))
+        return beats
+
+    def _delta_reference(self, data):
+        """ Layout of a delta-compressed frame: returns the number of
+        channels, the reference sample (a list with one value per channel)
+        and the offset of the first block of deltas.
+
+        A compressed frame holds a reference sample, with each channel a 
+        signed little-endian integer of ceil(resolution/8) bytes, followed 
+        by blocks of deltas from the previous sample. Each block starts 
+        with two bytes, the bit width of the deltas and the number of 
+        samples in the block, followed by the deltas of every channel of 
+        every sample, as signed integers of that width packed 
+        least-significant bit first.
+        """
+        meas=self.measurement_types[data[0]]
+        try:
+            channels=self.delta_frames[(meas, data[9])]
+        except KeyError:
+            raise ValueError(f"Unsupported {meas} frame type {data[9]:02x}")
+        resolution=self._resolution.get(meas, self.default_resolution[meas])
+        size=(resolution+7)//8
+        offset=10+channels*size
+        if offset>len(data):
+            raise ValueError(f"Bad compressed {meas} frame length")
+        reference=[int.from_bytes(data[pos:pos+size], 'little', signed=True)
+                   for pos in range(10, offset, size)]
+        return channels, reference, offset
+
+    def _delta_blocks(self, data, channels, offset):
+        """ Iterate over the blocks of deltas of a compressed frame, as
+        tuples (bit width, sample count, offset of the packed deltas) """
+        while offset<len(data):
+            if offset+2>len(data):
+                raise ValueError("Bad compressed frame length")
+            bits, count=data[offset], data[offset+1]
+            if bits>32:
+                raise ValueError(f"Unsupported delta width {bits}")
+            offset+=2
+            nbytes=(bits*count*channels+7)//8
+            if offset+nbytes>len(data):
+                raise ValueError("Bad compressed frame length")
+            yield bits, count, offset
+            offset+=nbytes
+
+    def _decode_delta_data(self, data):
+        """ Decode a delta-compressed frame into a list of tuples, one 
+        per sample, with the value of each channel """
+        channels, sample, offset=self._delta_reference(data)
+        samples=[tuple(sample)]
+        for bits, count, offset in self._delta_blocks(data, channels, 
+                                                      offset):
+            nbytes=(bits*count*channels+7)//8
+            packed=int.from_bytes(data[offset:offset+nbytes], 'little')
+            mask=(1<<bits)-1
+            sign=(1<<bits)>>1
+            for _ in range(count):
+                for channel in range(channels):
+                    delta=packed & mask
+                    packed>>=bits
+                    if delta & sign:
+                        delta-=1<<bits
+                    sample[channel]+=delta
+                samples.append(tuple(sample))
+        return samples
+
+    def _decode_delta_array(self, data):
+        """ Vectorized version of _decode_delta_data: returns an (n, 
+        channels) int32 NumPy array. The packed deltas of the blocks are
+        gathered without their headers, so that consecutive blocks of the
+        same width form one run of deltas. 
+        Each run is decoded with a single operation: byte-aligned widths 
+        are read directly with frombuffer, other widths as a matrix of 
+        bits (one row per delta) times the bit weights of the width. The 
+        samples are then rebuilt with a single cumsum. """
+        channels, reference, offset=self._delta_reference(data)
+        packed=bytearray()
+        runs=[] # [bit width, first bit in packed, number of deltas]
+        aligned=False # the last block ends on a byte boundary
+        for bits, count, start in self._delta_blocks(data, channels, 
+                                                     offset):
+            ndeltas=count*channels
+            if aligned and runs[-1][0]==bits:
+                runs[-1][2]+=ndeltas
+            else:
+                runs.append([bits, len(packed)*8, ndeltas])
+            aligned=(bits*ndeltas)%8==0
+            packed+=data[start:start+(bits*ndeltas+7)//8]
+        parts=[np.array(reference, dtype=np.int32)]
+        bitstream=None
+        for bits, first, ndeltas in runs:
+            dtype=self._delta_dtypes.get(bits)
+            if dtype!=None:
+                parts.append(np.frombuffer(packed, dtype=dtype, 
+                                           count=ndeltas, offset=first//8))
+                continue
+            if bitstream is None:
+                bitstream=np.unpackbits(np.frombuffer(packed, 
+                                                      dtype=np.uint8),
+                                        bitorder='little')
+            digits=bitstream[first:first+ndeltas*bits]
+            parts.append(np.dot(digits.reshape(ndeltas, bits),
+                                self._delta_weights[bits]))
+        # (ndarray.cumsum is cheaper to call than np.cumsum)
+        samples=np.concatenate(parts).reshape(-1, channels).cumsum(axis=0)
+        return samples.astype(np.int32, copy=False)
     
 
     async def available_measurements(self):
@@ -564,6 +1370,11 @@ class PolarMeasurementData:
             return (-2, 'Invalid CTRL point response', None)
         err_code=response[3]
         err_msg=self.error_msgs[err_code]
+        if err_code==0 and 'SAMPLE_RATE' in params:
+            self._sample_rate[measurement]=params['SAMPLE_RATE']
+            self._last_sensor_ts.pop(measurement, None)
+        if err_code==0 and 'RESOLUTION' in params:
+            self._resolution[measurement]=params['RESOLUTION']
         # Verity ACC reponse has FACTOR parameter, not handled here
         return (err_code, err_msg, response)
 
@@ -577,6 +1388,9 @@ class PolarMeasurementData:
         except ValueError:
             return  (-3, f"Unknown measurement type: {measurement}")
 
+        # deliver frames still held for batching
+        if measurement in self._batchers:
+            self._batchers[measurement].flush()
         cmd=self.op_codes['STOP']
         req=bytearray([cmd, meas_type])
         try:
@@ -588,3 +1402,11 @@ class PolarMeasurementData:
         err_code=response[3]
         err_msg=self.error_msgs[err_code]
         return (err_code, err_msg)
+
+
+if np!=None:
+    # entry w weighs the bits of a w-bit two's complement integer, least
+    # significant first: 1, 2, 4, ..., -2**(w-1)
+    PolarMeasurementData._delta_weights=[
+        np.left_shift(1, np.arange(width, dtype=np.int64))*np.where(
+            np.arange(width)==width-1, -1, 1) for width in range(33)]
@@ -0,0 +1,398 @@
+""" Replay recorded sessions through a stand-in for bleak.
+
+ReplayClient and ReplayScanner mimic the parts of BleakClient and
+BleakScanner used by bleakheart and the online scripts. Recordings in
+testdata (NNecgdata.csv / NNrrdata.csv pairs) are re-encoded into the
+bytes a Polar H10 sends on the PMD data and heart rate characteristics
+(heartbeats come from the rr file when it holds RR intervals, and are
+otherwise detected in the recorded ECG), and the PMD control point 
+answers settings, start and stop requests, so the real decoding and 
+processing pipeline runs on a machine without Bluetooth. Frames are 
+replayed in real time, at a multiple of real time or as fast as 
+possible.
+
+Typical use, in place of the bleak imports:
+    BleakScanner, BleakClient=replay_backend('testdata/[1]/02', speed=4)
+"""
+
+import os
+import csv
+import asyncio as aio
+from inspect import iscoroutinefunction
+from bleakheart import BatteryLevel, HeartRate, PolarMeasurementData
+from signalprocessing import StreamingPeakDetector
+
+# Polar sensors count time stamps from 2000-01-01T00:00:00Z
+POLAR_EPOCH_NS=946684800*1000000000
+
+# sampling rate of the recorded ECG (Polar H10)
+ECG_SAMPLING_RATE=130
+
+
+def encode_ecg_frame(sensor_ts, samples):
+    """ Encode ECG samples in microvolt as a PMD data frame of type 0x00,
+    time stamped (in ns, sensor clock) at the last sample """
+    meas=PolarMeasurementData.measurement_types.index('ECG')
+    frame=bytearray([meas])
+    frame.extend(sensor_ts.to_bytes(8, 'little', signed=False))
+    frame.append(0x00)
+    for sample in samples:
+        frame.extend(sample.to_bytes(3, 'little', signed=True))
+    return frame
+
+
+def restamp_frame(frame, sensor_ts):
+    """ A copy of a PMD data frame with its sensor time stamp (in ns)
+    replaced; frames that are not time stamped (PPI) are returned as they
+    are """
+    if not any(frame[1:9]):
+        return frame
+    frame=bytearray(frame)
+    frame[1:9]=sensor_ts.to_bytes(8, 'little', signed=False)
+    return frame
+
+
+def encode_delta_frame(measurement, sensor_ts, samples, resolution,
+                       block_size=16):
+    """ Encode samples as a delta-compressed PMD data frame of type 0x80,
+    as decoded by PolarMeasurementData.
+
+    Args:
+        measurement: 'ECG', 'ACC' or 'PPG'
+        sensor_ts: time stamp of the last sample (in ns, sensor clock)
+        samples: a list of tuples, one value per channel (for ECG, a list
+            of integers is accepted too)
+        resolution: bits per sample of the reference sample
+        block_size: number of samples in each block of deltas, at most
+            255; the bit width is chosen separately for each block
+    """
+    samples=[sample if isinstance(sample, (tuple, list)) else (sample,)
+             for sample in samples]
+    size=(resolution+7)//8
+    frame=bytearray([PolarMeasurementData.measurement_types.index(
+        measurement)])
+    frame.extend(sensor_ts.to_bytes(8, 'little', signed=False))
+    frame.append(0x80)
+    for value in samples[0]:
+        frame.extend(value.to_bytes(size, 'little', signed=True))
+    for start in range(1, len(samples), block_size):
+        block=samples[start:start+block_size]
+        previous=samples[start-1:start-1+len(block)]
+        deltas=[value-before for sample, last in zip(block, previous)
+                for value, before in zip(sample, last)]
+        # smallest two's complement width holding every delta
+        bits=max(delta.bit_length() for delta in deltas)+1
+        packed=0
+        for i, delta in enumerate(deltas):
+            packed|=(delta & ((1<<bits)-1))<<(i*bits)
+        frame.extend([bits, len(block)])
+        frame.extend(packed.to_bytes((bits*len(deltas)+7)//8, 'little'))
+    return frame
+
+
+def encode_ppi_frame(beats):
+    """ Encode beats, as tuples (hr, ppi, error, flags), as a PMD data
+    frame of type 0x00 with PPI data; like Polar sensors, the sensor 
+    time stamp is left at 0 """
+    meas=PolarMeasurementData.measurement_types.index('PPI')
+    frame=bytearray([meas])
+    frame.extend(bytes(8))
+    frame.append(0x00)
+    for beat in beats:
+        frame.extend(PolarMeasurementData._ppi_layout.pack(*beat))
+    return frame
+
+
+def encode_hr_frame(hr, rrlist):
+    """ Encode a heart rate measurement (in bpm, at most 255) with RR 
+    intervals (in ms) as sent on the heart rate characteristic by the 
+    Polar H10 """
+    frame=bytearray([0x10, hr]) # flags: uint8 hr, RR intervals present
+    for rr in rrlist:
+        # RR intervals are sent in 1/1024 s
+        frame.extend(round(rr*1024/1000).to_bytes(2, 'little'))
+    return frame
+
+
+def ecg_beats(frames, sampling_rate=ECG_SAMPLING_RATE):
+    """ Detect heartbeats in recorded ECG frames.
+
+    Args:
+        frames: a time-ordered list of (host_ts, samples) tuples
+        sampling_rate: sampling rate of the ECG in Hz
+    Returns:
+        A list of (host_ts, rr) tuples, one for each beat after the first,
+        with the RR interval in ms; host_ts is the time stamp of the frame
+        that confirmed the beat, when a sensor would report it
+    """
+    detector=StreamingPeakDetector(sampling_rate)
+    beats=[]
+    last_peak=None
+    last_ts=None
+    for host_ts, samples in frames:
+        # a gap of more than a frame: the beats on either side of it are
+        # not consecutive
+        duration=len(samples)/sampling_rate
+        if last_ts!=None and (host_ts-last_ts)*1e-9>2*duration:
+            detector.reset()
+            last_peak=None
+        last_ts=host_ts
+        for peak in detector.process(samples).r_peaks:
+            if last_peak!=None and peak>last_peak:
+                beats.append((host_ts, round((peak-last_peak)*1000/
+                                             sampling_rate)))
+            last_peak=peak
+    return beats
+
+
+def load_recording(recording):
+    """ Load a recording and encode its frames.
+
+    Args:
+        recording: path prefix of an ecg/rr pair of csv files, e.g.
+            'testdata/[1]/02' for 02ecgdata.csv and 02rrdata.csv. The rr
+            file is optional, and only used if it has an rr_interval 
+            column: in most recordings its rr column holds ECG samples
+            rather than RR intervals
+    Returns:
+        A time-ordered list of tuples (host_ts, characteristic, frame).
+        Each heartbeat, from the rr file or else detected in the ECG, is 
+        sent both as a heart rate frame and as a PPI frame (with skin 
+        contact and no blocker)
+    """
+    events=[]
+    frames=[]
+    with open(recording+'ecgdata.csv', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            host_ts=int(row['time'])
+            samples=[int(v) for v in row['ecg'].strip('[]').split(',')]
+            frames.append((host_ts, samples))
+            frame=encode_ecg_frame(host_ts-POLAR_EPOCH_NS, samples)
+            events.append((host_ts, PolarMeasurementData.PMDDATAMTU, frame))
+    rr_intervals=[]
+    if os.path.exists(recording+'rrdata.csv'):
+        with open(recording+'rrdata.csv', newline='') as csv_file:
+            reader=csv.DictReader(csv_file)
+            if 'rr_interval' in reader.fieldnames:
+                rr_intervals=[(int(row['time']), 
+                               int(float(row['rr_interval'])))
+                              for row in reader]
+    if events and rr_intervals and (rr_intervals[0][0]>events[-1][0] or
+                                    rr_intervals[-1][0]<events[0][0]):
+        # the two files were captured in separate sessions: start both 
+        # streams together
+        shift=events[0][0]-rr_intervals[0][0]
+        rr_intervals=[(host_ts+shift, rr) for host_ts, rr in rr_intervals]
+    if not rr_intervals:
+        rr_intervals=ecg_beats(frames)
+    for host_ts, rr in rr_intervals:
+        hr=min(round(60000/rr), 255)
+        events.append((host_ts, HeartRate.CHARACTERISTIC, 
+                       encode_hr_frame(hr, [rr])))
+        events.append((host_ts, PolarMeasurementData.PMDDATAMTU,
+                       encode_ppi_frame([(hr, rr, 10, 0x06)])))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+class ReplayDevice:
+    """ Stand-in for bleak's BLEDevice """
+
+    def __init__(self, recording):
+        self.recording=recording
+        self.address=f"REPLAY:{recording}"
+        self.name=f"Polar H10 REPLAY {os.path.basename(recording)}"
+        self.local_name=self.name # doubles as advertisement data
+
+    def __str__(self):
+        return f"{self.address}: {self.name}"
+
+
+class ReplayClient:
+    """ Stand-in for BleakClient that streams a recording. The sensor
+    time stamps of PMD frames follow the replay clock, so they keep pace
+    with the arrival times at any speed. Notification callbacks are 
+    called with None in place of the characteristic object; coroutine 
+    callbacks are awaited in turn, so frames are delivered in order and a
+    slow consumer slows down the replay. When the recording ends the 
+    client disconnects, calling disconnected_callback. """
+    # set by replay_backend
+    speed=1.0
+    devices={}
+
+    def __init__(self, address_or_device, disconnected_callback=None,
+                 **kwargs):
+        if isinstance(address_or_device, ReplayDevice):
+            self.device=address_or_device
+        else:
+            self.device=self.devices[address_or_device]
+        self.address=self.device.address
+        self._disconnected_callback=disconnected_callback
+        self.is_connected=False
+        self._callbacks={}
+        self._streaming=set() # PMD measurements started
+        self._player=None
+        self._tasks=set() # keeps control point responses alive
+
+    def __str__(self):
+        return f"ReplayClient, {self.address}"
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self, **kwargs):
+        self.is_connected=True
+        return True
+
+    async def disconnect(self):
+        if self._player!=None:
+            self._player.cancel()
+            self._player=None
+        self.is_connected=False
+        return True
+
+    async def start_notify(self, characteristic, callback, **kwargs):
+        self._callbacks[str(characteristic).upper()]=callback
+        if (characteristic==HeartRate.CHARACTERISTIC and
+            self._player==None):
+            self._player=aio.create_task(self._play())
+
+    async def stop_notify(self, characteristic):
+        self._callbacks.pop(str(characteristic).upper(), None)
+
+    async def read_gatt_char(self, characteristic, **kwargs):
+        if characteristic==PolarMeasurementData.PMDCTRLPOINT:
+            # feature read: ECG and PPI are available in the recordings
+            return bytearray([0x0F, 0x09])
+        if characteristic==BatteryLevel.CHARACTERISTIC:
+            return bytearray([100])
+        raise ValueError(f"Characteristic {characteristic} not replayed")
+
+    async def write_gatt_char(self, characteristic, data, response=None):
+        if characteristic!=PolarMeasurementData.PMDCTRLPOINT:
+            raise ValueError(f"Characteristic {characteristic} not replayed")
+        response=self._pmd_ctrl_response(bytes(data))
+        # the response arrives as a notification, after the write returns
+        task=aio.create_task(
+            self._notify(PolarMeasurementData.PMDCTRLPOINT, response))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _pmd_ctrl_response(self, request):
+        """ Answer a PMD control point request as the H10 would """
+        op, meas=request[0], request[1]
+        status=0x00
+        params=bytearray()
+        measurement=PolarMeasurementData.measurement_types[meas]
+        if measurement not in ('ECG', 'PPI'):
+            status=PolarMeasurementData.error_msgs.index('NOT SUPPORTED')
+        elif op==PolarMeasurementData.op_codes['GET']:
+            # PPI has no settings
+            settings=PolarMeasurementData.settings
+            for name, value in PolarMeasurementData.default_settings.get(
+                    measurement, {}).items():
+                params.extend([settings.index(name), 0x01])
+                params.extend(value.to_bytes(2, 'little'))
+        elif op==PolarMeasurementData.op_codes['START']:
+            if measurement in self._streaming:
+                status=PolarMeasurementData.error_msgs.index(
+                    'ALREADY IN STATE')
+            self._streaming.add(measurement)
+            if self._player==None:
+                self._player=aio.create_task(self._play())
+        elif op==PolarMeasurementData.op_codes['STOP']:
+            self._streaming.discard(measurement)
+        else:
+            status=PolarMeasurementData.error_msgs.index('INVALID OP CODE')
+        return bytearray([0xF0, op, meas, status, 0x00])+params
+
+    async def _notify(self, characteristic, data):
+        """ Pass data to the callback registered for characteristic """
+        callback=self._callbacks.get(characteristic.upper())
+        if callback==None:
+            return
+        if iscoroutinefunction(callback):
+            await callback(None, data)
+        else:
+            callback(None, data)
+
+    async def _play(self):
+        """ Stream the recording, then disconnect """
+        try:
+            events=load_recording(self.device.recording)
+            loop=aio.get_running_loop()
+            start=loop.time()
+            first=events[0][0] if events else 0
+            pmd=PolarMeasurementData.PMDDATAMTU.upper()
+            measurements=PolarMeasurementData.measurement_types
+            for host_ts, characteristic, frame in events:
+                if self.speed:
+                    # time of the event on the replay clock, which runs
+                    # speed times as fast as the recording's
+                    replay_ts=first+round((host_ts-first)/self.speed)
+                    delay=start+(replay_ts-first)*1e-9-loop.time()
+                    await aio.sleep(max(delay, 0))
+                else:
+                    await aio.sleep(0)
+                    # as fast as possible: the replay clock is a virtual
+                    # one, which runs as the frames are sent
+                    replay_ts=first+round((loop.time()-start)*1e9)
+                if characteristic==pmd:
+                    if measurements[frame[0]] not in self._streaming:
+                        continue
+                    frame=restamp_frame(frame, replay_ts-POLAR_EPOCH_NS)
+                await self._notify(characteristic, frame)
+        finally:
+            # the sensor goes away at the end of the recording, or if the
+            # replay fails
+            self._player=None
+            self.is_connected=False
+            if self._disconnected_callback!=None:
+                self._disconnected_callback(self)
+
+
+class ReplayScanner:
+    """ Stand-in for BleakScanner that finds one device per recording """
+    devices={}
+
+    @classmethod
+    async def discover(cls, timeout=5.0, **kwargs):
+        return list(cls.devices.values())
+
+    @classmethod
+    async def find_device_by_filter(cls, filterfunc, timeout=10.0, **kwargs):
+        for device in cls.devices.values():
+            if filterfunc(device, device):
+                return device
+        return None
+
+    @classmethod
+    async def find_device_by_address(cls, device_identifier, timeout=10.0,
+                                     **kwargs):
+        return cls.devices.get(device_identifier)
+
+
+def replay_backend(*recordings, speed=1.0):
+    """ Create scanner and client classes replaying the given recordings.
+
+    Args:
+        recordings: one or more recording path prefixes, see
+            load_recording
+        speed: replay speed as a multiple of real time; None or 0 replays
+            as fast as possible
+    Returns:
+        A tuple (scanner class, client class) to use in place of
+        BleakScanner and BleakClient
+    """
+    devices={}
+    for recording in recordings:
+        device=ReplayDevice(recording)
+        devices[device.address]=device
+    scanner=type('ReplayScanner', (ReplayScanner,), {'devices': devices})
+    client=type('ReplayClient', (ReplayClient,),
+                {'devices': devices, 'speed': speed})
+    return scanner, client
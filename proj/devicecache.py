@@ -0,0 +1,99 @@
+""" On-disk cache of the last Polar device used and its PMD settings.
+
+With the address of the last sensor on file, startup waits only until
+that sensor advertises instead of running a full scan; with its settings
+on file, the available_settings control point round trip is skipped.
+A full scan happens only when the cached sensor cannot be found.
+
+Replayed sessions (see blereplay.py) use a cache without a path, which
+is kept in memory only, so that the stand-in device does not replace 
+the cached sensor.
+"""
+
+import os
+import json
+
+CACHE_PATH=os.path.join(os.path.expanduser('~'), '.ecgmelodies_device.json')
+
+
+class DeviceCache:
+    """ The last used device (address and name) and the PMD settings it
+    reported, by measurement type, stored as JSON; with path None, 
+    nothing is read from or written to disk. """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path=path
+        if path==None:
+            self._data={}
+            return
+        try:
+            with open(path) as cache_file:
+                self._data=json.load(cache_file)
+        except (OSError, ValueError):
+            # missing or corrupt cache: start afresh
+            self._data={}
+
+    @property
+    def address(self):
+        """ Address of the last used device, or None """
+        return self._data.get('address')
+
+    def settings(self, measurement):
+        """ Cached settings for measurement, as returned by
+        PolarMeasurementData.available_settings, or None """
+        return self._data.get('settings', {}).get(measurement)
+
+    def remember_device(self, device):
+        """ Store the device; settings of a different device are
+        discarded """
+        if device.address!=self.address:
+            self._data={'address': device.address, 'name': device.name,
+                        'settings': {}}
+            self._save()
+
+    def remember_settings(self, measurement, settings):
+        """ Store the settings reported for measurement, unless the query
+        failed """
+        if settings.get('error_code')!=0:
+            return
+        self._data.setdefault('settings', {})[measurement]=dict(settings)
+        self._save()
+
+    def forget(self):
+        """ Clear the cache """
+        self._data={}
+        self._save()
+
+    def _save(self):
+        if self.path==None:
+            return
+        # write to a temporary file first, so an interrupted write cannot
+        # leave a truncated cache behind
+        tmp_path=self.path+'.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self._data, cache_file, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+async def find_device(cache, scanner, timeout=5.0):
+    """ Look for the cached device, falling back on a full scan for any
+    Polar device.
+
+    Args:
+        cache: a DeviceCache
+        scanner: BleakScanner or a stand-in
+        timeout: how long to wait for the cached device to advertise
+    Returns:
+        The device, or None if no Polar device was found
+    """
+    if cache.address!=None:
+        device=await scanner.find_device_by_address(cache.address,
+                                                    timeout=timeout)
+        if device!=None:
+            return device
+        print(f"Last used device {cache.address} not found, scanning")
+    device=await scanner.find_device_by_filter(
+        lambda dev, adv: dev.name and "polar" in dev.name.lower())
+    if device!=None:
+        cache.remember_device(device)
+    return device
@@ -0,0 +1,156 @@
+""" Append-only binary log of raw sensor notifications.
+
+FrameRecorder appends the raw characteristic bytes received by
+PolarMeasurementData and HeartRate (pass recorder= to either) to a
+length-prefixed binary log, through a buffered writer. Every record is
+    uint32 length | uint8 source | int64 host time stamp (ns) | data
+little-endian, after an 8-byte file header. Each index_every records,
+the (time stamp, file offset) of the record is appended to a sparse
+index in a companion '.idx' file, so that FrameLog can memory-map the
+log and seek to any time with a binary search over the index followed
+by a short linear scan.
+
+Frames are stored exactly as received, so any decoder (present or
+future) can be run on them later, and a session can be replayed.
+"""
+
+import os
+import mmap
+import struct
+from bisect import bisect_left
+
+MAGIC=b'BHFRLOG1'
+RECORD=struct.Struct('<IBq')
+INDEX_ENTRY=struct.Struct('<qQ')
+# the source byte of each record
+SOURCES=['PMD', 'HR']
+
+
+class FrameRecorder:
+    """ Appends raw frames with host time stamps to a binary log """
+
+    def __init__(self, path, index_every=64, buffer_size=1<<16):
+        """ Init the FrameRecorder object. An existing log is appended to.
+
+        Args:
+
+        path: the log file; the index is written to path+'.idx'
+        index_every: number of records between index entries
+        buffer_size: size of the write buffers in bytes
+        """
+        self.path=path
+        self.index_every=index_every
+        new=not os.path.exists(path) or os.path.getsize(path)==0
+        self._log=open(path, 'ab', buffering=buffer_size)
+        # the index of a new log starts afresh, even if a stale one is left
+        self._index=open(path+'.idx', 'wb' if new else 'ab', 
+                         buffering=buffer_size)
+        if new:
+            self._log.write(MAGIC)
+        self._offset=self._log.tell()
+        self._count=0
+        self.records=0
+
+    def record(self, source, tstamp, data):
+        """ Append a frame.
+
+        Args:
+            source: one of the strings in SOURCES
+            tstamp: host time stamp in ns
+            data: the raw characteristic value
+        """
+        if self._count%self.index_every==0:
+            self._index.write(INDEX_ENTRY.pack(tstamp, self._offset))
+        self._count+=1
+        self._log.write(RECORD.pack(len(data), SOURCES.index(source), tstamp))
+        self._log.write(data)
+        self._offset+=RECORD.size+len(data)
+        self.records+=1
+
+    def flush(self):
+        """ Write buffered records to disk """
+        self._log.flush()
+        self._index.flush()
+
+    def close(self):
+        self._log.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class FrameLog:
+    """ Reads a log written by FrameRecorder through a memory map """
+
+    def __init__(self, path):
+        self.path=path
+        with open(path, 'rb') as log_file:
+            self._map=mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)]!=MAGIC:
+            raise ValueError(f"{path} is not a frame log")
+        self._index_ts=[]
+        self._index_offset=[]
+        try:
+            with open(path+'.idx', 'rb') as index_file:
+                index=index_file.read()
+        except OSError:
+            # without an index every seek scans from the start
+            index=b''
+        for tstamp, offset in INDEX_ENTRY.iter_unpack(
+                index[:len(index)-len(index)%INDEX_ENTRY.size]):
+            # entries past the end of the log were never flushed to it
+            if offset<len(self._map):
+                self._index_ts.append(tstamp)
+                self._index_offset.append(offset)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _read(self, offset):
+        """ The record at offset, as (tstamp, source, data, next offset),
+        or None at the end of the log (or of a truncated record) """
+        end=offset+RECORD.size
+        if end>len(self._map):
+            return None
+        length, source, tstamp=RECORD.unpack_from(self._map, offset)
+        if end+length>len(self._map):
+            return None
+        data=memoryview(self._map)[end:end+length]
+        return tstamp, SOURCES[source], data, end+length
+
+    def seek(self, tstamp):
+        """ File offset of the first record with time stamp >= tstamp """
+        # start from the last entry before tstamp: entries at tstamp may be
+        # preceded by records with the same time stamp
+        i=bisect_left(self._index_ts, tstamp)-1
+        offset=self._index_offset[i] if i>=0 else len(MAGIC)
+        while True:
+            record=self._read(offset)
+            if record==None or record[0]>=tstamp:
+                return offset
+            offset=record[3]
+
+    def records(self, start=None, end=None):
+        """ Iterate over the records with start <= time stamp < end, as
+        tuples (tstamp, source, data), where data is a memoryview on the
+        log (release it, or copy with bytes(), before closing the log).
+        Time stamps are in ns; None means no limit. """
+        offset=len(MAGIC) if start==None else self.seek(start)
+        while True:
+            record=self._read(offset)
+            if record==None:
+                return
+            tstamp, source, data, offset=record
+            if end!=None and tstamp>=end:
+                return
+            yield tstamp, source, data
@@ -0,0 +1,219 @@
+""" Time-aligned windows from streams that arrive at different rates.
+
+Each stream (e.g. ECG frames and heart rate frames) is drained from its
+queue by its own feed() task into a StreamMerger, which groups frames by
+time stamp into consecutive windows of a fixed time span. A window is
+released once every stream has moved past its end, so the frames of all
+streams in a window cover the same stretch of time. A stream that falls
+silent (no heartbeats, a stalled queue) holds the others back for at
+most `lateness` seconds: after that the window is released without
+waiting for it, and frames that turn up later for released windows are
+dropped and counted.
+
+Gap markers (see reconnect.py) discard the partial window and any frame
+from before the gap; QUIT markers close a stream, and the merger ends
+when all streams are closed.
+
+A WindowAccumulator copies the payloads of the frames of a window into
+a preallocated NumPy buffer, so that processing functions get the
+samples as an array view, with no parsing and no new allocation.
+"""
+
+import asyncio as aio
+from collections import namedtuple, deque
+import numpy as np
+
+# frames holds a list of frames for each stream, keyed by stream name
+Window=namedtuple('Window', ['start', 'end', 'frames'])
+
+
+class StreamMerger:
+    """ Merges timestamped frames from several streams into windows of
+    span seconds, in time order. Frames are tuples with the host time
+    stamp (ns) as second element, as produced by bleakheart; frames of
+    each stream must arrive in time stamp order.
+
+    Attributes:
+
+    late: number of frames dropped because their window had already been
+          released (or they predate a gap)
+    released: number of windows released
+    """
+
+    def __init__(self, streams, span=5.0, lateness=2.0):
+        """ Init the StreamMerger object.
+
+        Args:
+
+        streams: the names of the streams, e.g. ['ecg', 'hr']
+        span: duration of each window, in seconds
+        lateness: how long (in seconds of stream time) a lagging stream
+                  can hold back the release of a window
+        """
+        self.span=int(span*1e9)
+        self.lateness=int(lateness*1e9)
+        self._pending={stream: deque() for stream in streams}
+        self._watermark={stream: None for stream in streams}
+        self._open=set(streams)
+        self._start=None
+        self._floor=None # frames before this time stamp are late
+        self._windows=aio.Queue()
+        self.late=0
+        self.released=0
+
+    def push(self, stream, frame):
+        """ Add a frame of stream; releases the windows it completes """
+        tstamp=frame[1]
+        if self._floor!=None and tstamp<self._floor:
+            self.late+=1
+            return
+        self._pending[stream].append(frame)
+        self._watermark[stream]=tstamp
+        if self._start==None or (self._floor==None and tstamp<self._start):
+            # the first window starts with the oldest frame
+            self._start=tstamp
+        self._release()
+
+    def gap(self, stream, tstamp):
+        """ The stream has a discontinuity at tstamp (ns): drop the
+        partial window and every frame older than the gap """
+        for frames in self._pending.values():
+            while frames and frames[0][1]<tstamp:
+                frames.popleft()
+        self._floor=tstamp if self._floor==None else max(self._floor,
+                                                         tstamp)
+        self._start=self._earliest()
+
+    def close(self, stream):
+        """ No more frames will come from stream; once all streams are
+        closed, get() returns None """
+        self._open.discard(stream)
+        if self._open:
+            self._release()
+        else:
+            self._windows.put_nowait(None)
+
+    async def get(self):
+        """ The next window, or None when all streams are closed """
+        return await self._windows.get()
+
+    def _earliest(self):
+        """ Time stamp of the oldest pending frame, or None """
+        heads=[frames[0][1] for frames in self._pending.values() if frames]
+        return min(heads) if heads else None
+
+    def _ready(self, end):
+        """ True if the window ending at end can be released """
+        # a stream that has sent nothing yet counts as being at the start
+        marks=[self._start if self._watermark[stream]==None
+               else self._watermark[stream] for stream in self._open]
+        leader=max(marks)
+        if leader<end:
+            return False
+        # every stream must have passed the end, or lag so far behind the
+        # leader that waiting for it any longer would stall the others
+        return all(mark>=end or mark<leader-self.lateness for mark in marks)
+
+    def _release(self):
+        """ Release every complete window """
+        while self._start!=None and self._ready(self._start+self.span):
+            end=self._start+self.span
+            frames={}
+            for stream, pending in self._pending.items():
+                frames[stream]=[]
+                while pending and pending[0][1]<end:
+                    frames[stream].append(pending.popleft())
+            # stretches with no frames at all are skipped
+            if any(frames.values()):
+                self._windows.put_nowait(Window(self._start, end, frames))
+                self.released+=1
+            self._floor=end
+            self._start=end
+
+
+class WindowAccumulator:
+    """ Gathers the payloads of a list of frames into a preallocated
+    buffer. gather() writes to one of depth buffers in turn, so a view
+    it returned stays valid for the next depth-1 calls: use a depth of
+    at least the number of windows that can be in processing at once,
+    plus one. A buffer that is too small for a window is replaced by 
+    one twice as large (or as large as needed).
+
+    Attributes:
+
+    counts: number of samples in each frame of the last window
+    timestamps: time stamp (ns) of each frame of the last window
+    """
+
+    def __init__(self, capacity=1024, frames=64, depth=1, 
+                 dtype=np.float64, select=None):
+        """ Init the WindowAccumulator object.
+
+        Args:
+
+        capacity: initial number of samples in each buffer
+        frames: initial number of frames per window
+        depth: number of buffers used in turn
+        dtype: NumPy type of the samples
+        select: function returning the payload of a frame (an array, a
+                list or a single number); by default the third element,
+                e.g. the samples of ECG frames. For heart rate frames, 
+                select=lambda frame: frame[2][0] gathers the heart rates
+        """
+        self.dtype=dtype
+        self.select=(lambda frame: frame[2]) if select==None else select
+        self._buffers=[np.empty(capacity, dtype=dtype) for i in range(depth)]
+        self._next=0
+        self._counts=np.zeros(frames, dtype=np.int64)
+        self._timestamps=np.zeros(frames, dtype=np.int64)
+        self.counts=self._counts[:0]
+        self.timestamps=self._timestamps[:0]
+
+    def gather(self, frames):
+        """ Copy the payloads of frames into the next buffer; return the
+        samples as a view on it """
+        if len(frames)>len(self._counts):
+            size=max(len(frames), 2*len(self._counts))
+            self._counts=np.zeros(size, dtype=np.int64)
+            self._timestamps=np.zeros(size, dtype=np.int64)
+        slot=self._next
+        self._next=(slot+1)%len(self._buffers)
+        buffer=self._buffers[slot]
+        n=0
+        for i, frame in enumerate(frames):
+            payload=self.select(frame)
+            count=np.size(payload)
+            if n+count>len(buffer):
+                grown=np.empty(max(n+count, 2*len(buffer)), dtype=self.dtype)
+                grown[:n]=buffer[:n]
+                buffer=self._buffers[slot]=grown
+            buffer[n:n+count]=payload
+            self._counts[i]=count
+            self._timestamps[i]=frame[1]
+            n+=count
+        self.counts=self._counts[:len(frames)]
+        self.timestamps=self._timestamps[:len(frames)]
+        return buffer[:n]
+
+
+async def feed(queue, merger, stream, instrument=None):
+    """ Move frames from queue to the merger until a QUIT marker arrives.
+
+    Args:
+        queue: the asyncio queue the frames arrive on
+        merger: a StreamMerger
+        stream: name of the stream in the merger
+        instrument: a bleakheart Instrumentation object, told about each
+            frame taken off the queue
+    """
+    while True:
+        frame=await queue.get()
+        if frame[0]=='QUIT':
+            merger.close(stream)
+            return
+        if frame[0]=='GAP':
+            merger.gap(stream, frame[1])
+            continue
+        if instrument!=None:
+            instrument.mark_dequeued(frame[0])
+        merger.push(stream, frame)
@@ -0,0 +1,195 @@
+""" Concurrent acquisition from several Polar sensors on one event loop.
+
+SensorManager discovers Polar devices, connects to all of them at once
+and streams ECG and heart rate from each into its own pair of ring
+buffers, so one host can serve several people. Per-device counters
+report throughput and dropped samples, to tell how many straps a single
+core can keep up with.
+
+Run from this directory:
+    python multisensor.py [number of sensors]
+"""
+
+import sys
+import time
+import asyncio as aio
+from bleak import BleakScanner, BleakClient
+from bleakheart import PolarMeasurementData, HeartRate
+from ringbuffer import RingBuffer
+
+
+class SensorSession:
+    """ State of one sensor: its ring buffers and counters. Frames are
+    counted as they arrive, before they reach the buffers.
+
+    Attributes:
+
+    device_id: the address of the device, used to tag its data
+    ecg: RingBuffer of ECG samples in microVolt
+    hr:  RingBuffer of (hr, rr) samples, one per heartbeat
+    connected: asyncio Event set while the sensor streams
+    """
+
+    def __init__(self, device, ecg_capacity, hr_capacity):
+        self.device=device
+        self.device_id=device.address
+        self.ecg=RingBuffer(ecg_capacity, sample_rate=130)
+        self.hr=RingBuffer(hr_capacity, width=2)
+        self.connected=aio.Event()
+        self.frames={'ECG': 0, 'HR': 0}
+        self.samples={'ECG': 0, 'HR': 0}
+        self.started=None
+        self.error=None
+
+    def on_ecg(self, frame):
+        """ ECG callback for PolarMeasurementData """
+        self.frames['ECG']+=1
+        self.samples['ECG']+=len(frame[2])
+        self.ecg.put_nowait(frame)
+
+    def on_hr(self, frame):
+        """ Callback for HeartRate (unpacked frames) """
+        self.frames['HR']+=1
+        self.samples['HR']+=1
+        self.hr.put_nowait(frame)
+
+    def stats(self):
+        """ Counters for this sensor as a dictionary; rates are per
+        second since streaming started """
+        elapsed=time.monotonic()-self.started if self.started else 0
+        stats={'connected': self.connected.is_set(), 'error': self.error}
+        for label, ring in (('ECG', self.ecg), ('HR', self.hr)):
+            key=label.lower()
+            stats[f'{key}_frames']=self.frames[label]
+            stats[f'{key}_samples']=self.samples[label]
+            stats[f'{key}_rate']=(self.samples[label]/elapsed if elapsed
+                                  else 0.0)
+            stats[f'{key}_dropped']=ring.dropped
+            stats[f'{key}_overruns']=ring.overruns
+            stats[f'{key}_backlog']=len(ring)
+        return stats
+
+
+class SensorManager:
+    """ Discovers and connects several Polar sensors concurrently. Each
+    device gets its own PolarMeasurementData and HeartRate objects, and a
+    SensorSession holding its buffers, available in the sessions
+    dictionary under the device address. """
+
+    def __init__(self, scanner=BleakScanner, client_class=BleakClient,
+                 ecg_capacity=130*60, hr_capacity=600):
+        """ Init the SensorManager object.
+
+        Args:
+
+        scanner: the scanner class, BleakScanner or a stand-in
+        client_class: the client class, BleakClient or a stand-in
+        ecg_capacity: size of each ECG ring buffer in samples
+        hr_capacity: size of each heart rate ring buffer in heartbeats
+        """
+        self.scanner=scanner
+        self.client_class=client_class
+        self.ecg_capacity=ecg_capacity
+        self.hr_capacity=hr_capacity
+        self.sessions={}
+
+    async def discover(self, count=None, timeout=10.0):
+        """ Scan for Polar devices; return at most count of them """
+        devices=await self.scanner.discover(timeout=timeout)
+        polar=[dev for dev in devices
+               if dev.name and "polar" in dev.name.lower()]
+        return polar if count==None else polar[:count]
+
+    async def run(self, devices, quit_event):
+        """ Connect to all devices and stream until quit_event is set or
+        every sensor has disconnected """
+        for device in devices:
+            self.sessions[device.address]=SensorSession(
+                device, self.ecg_capacity, self.hr_capacity)
+        await aio.gather(*(self._run_session(session, quit_event)
+                           for session in self.sessions.values()))
+
+    async def _run_session(self, session, quit_event):
+        """ Connection and streaming for one sensor """
+        disconnected=aio.Event()
+
+        def disconnected_callback(client):
+            disconnected.set()
+
+        try:
+            async with self.client_class(session.device,
+                                         disconnected_callback=
+                                         disconnected_callback) as client:
+                pmd=PolarMeasurementData(client, callback=session.on_ecg,
+                                         ecg_array=True,
+                                         drift_correction=True)
+                heartrate=HeartRate(client, callback=session.on_hr,
+                                    instant_rate=True, unpack=True)
+                (err_code, err_msg, _)=await pmd.start_streaming('ECG')
+                if err_code!=0:
+                    session.error=err_msg
+                    return
+                await heartrate.start_notify()
+                session.started=time.monotonic()
+                session.connected.set()
+                waiters=[aio.create_task(quit_event.wait()),
+                         aio.create_task(disconnected.wait())]
+                await aio.wait(waiters, return_when=aio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+                if client.is_connected:
+                    await pmd.stop_streaming('ECG')
+                    await heartrate.stop_notify()
+        except Exception as e:
+            session.error=str(e)
+        finally:
+            session.connected.clear()
+            # wake up readers of the buffers
+            session.ecg.close()
+            session.hr.close()
+
+    def stats(self):
+        """ Per-device counters, keyed by device address """
+        return {device_id: session.stats()
+                for device_id, session in self.sessions.items()}
+
+
+async def drain(session):
+    """ Stand-in consumer: read ECG one second at a time until the
+    sensor goes away """
+    while True:
+        samples, times=await session.ecg.read(130)
+        if len(samples)==0:
+            break
+
+
+async def main(count):
+    manager=SensorManager()
+    print(f"Scanning for {count} Polar devices")
+    devices=await manager.discover(count)
+    if not devices:
+        print("Polar device not found.")
+        sys.exit(-4)
+    quit_event=aio.Event()
+    loop=aio.get_running_loop()
+    loop.add_reader(sys.stdin, lambda: (input(), quit_event.set()))
+    print(f"Connecting to {len(devices)} devices")
+    print(">>> Hit Enter to exit <<<")
+    runner=aio.create_task(manager.run(devices, quit_event))
+    await aio.sleep(0) # let the manager create the sessions
+    consumers=[aio.create_task(drain(session))
+               for session in manager.sessions.values()]
+    while not runner.done():
+        await aio.sleep(5)
+        for device_id, stats in manager.stats().items():
+            print(f"{device_id}: {stats['ecg_rate']:.0f} ECG samples/s, "
+                  f"{stats['ecg_dropped']} dropped, "
+                  f"{stats['hr_samples']} beats")
+    await aio.gather(*consumers)
+    loop.remove_reader(sys.stdin)
+    print("Bye.")
+
+
+if __name__ == "__main__":
+    count=int(sys.argv[1]) if len(sys.argv)>1 else 2
+    aio.run(main(count))
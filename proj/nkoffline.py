@@ -1,206 +1,88 @@
+""" Offline sonification of a recording: the ECG goes through the 
+processing of the online application (nkonline.py), window by window,
+with heart rates taken from the detected R peaks, and the melody is 
+either played live or rendered to a WAV file as fast as the CPU allows """
+
 import numpy as np
-import pandas as pd
-import numpy as np
-import neurokit2 as nk
-import re
 
-from pyo import *
-from scipy.signal import find_peaks
-from collections import deque
-from appJar import gui 
+from pyo import Server
+from recording import load_ecg
+from signalprocessing import ecg_signalprocessing, rr_signalprocessing
+from sonification import SonificationEngine, play_windows, render
 
 
 ''' pre requisites '''
+# file_path_qrs can also be a binary bundle made with recording.py, e.g. 
+# 'testdata/[1]/02ecgdata.ecgb', which loads much faster
 file_path_qrs = 'testdata/[1]/02ecgdata.csv'  # Adjust the path as necessary
-qrsdata = pd.read_csv(file_path_qrs)
-file_path_rr='testdata/[1]/02rrdata.csv'
-rrdata=pd.read_csv(file_path_rr)
 
-arr=np.array([])
-offsets=[0]
-times=[]
+# set RENDER to a file name, e.g. 'melody.wav', to render the melody to a WAV
+# file instead of playing it; rendering runs as fast as the CPU allows
+RENDER = None
+# the data is processed and played in windows of WINDOW_SPAN seconds, as in
+# the online application
+WINDOW_SPAN = 5.6
+# sampling rate of the recorded ECG (Polar H10)
+SAMPLING_RATE = 130
 
 
-s = Server().boot().start()
-osc= Sine()
-
 ''' signal processing '''
-def signalProcessing(data,arr,offsets,times):
-    for item in range(0,len(qrsdata)): 
-        # clean, convert & standardise data so it is ready for processing
-        clean = re.sub(r'[^\d.\s]', '', qrsdata.loc[item, 'ecg'])
-        conversion = np.array([float(num) for num in clean.split()])
-
-        # create numpy arrays that contain data and timestamps seperately 
-        arr = np.append(arr,conversion)
-        offsets.append(len(arr))
-        times.append(qrsdata.loc[item, 'time'])
-
-    # put data through processing using 'ecg_processing()' 
-    signals, info = nk.ecg_process(arr, sampling_rate=50,method='neurokit')
-
-    qrs_durations = []
-    r_peaks = info['ECG_R_Peaks'] # storing r-peak results
-    q_peaks = info['ECG_Q_Peaks'] # storing q-peak results
-    s_peaks = info['ECG_S_Peaks'] # storing s-peak results
-
-    # qrs duration processing 
-    for r in r_peaks:
-        # find the nearest Q and S peaks around each R peak
-        q = max([q for q in q_peaks if q < r], default=None)
-        s = min([s for s in s_peaks if s > r], default=None)
-
-        if q is not None and s is not None:
-            # calculate the QRS duration in terms of samples
-            qrs_duration_samples = s - q
-
-            # convert samples to time using sampling rate
-            qrs_duration_seconds = qrs_duration_samples / 50  # Sampling rate
-            qrs_durations.append(qrs_duration_seconds)
-
-    rr_values = [0.9,0.8,1.2,1.1,0.9,0.7,0.5,0.8,0.7]
-
-    return{
-        "R Peaks": r_peaks,
-        "Q Peaks": q_peaks,
-        "S Peaks": s_peaks,
-        "QRS Durations": qrs_durations,
-        "RR Values": rr_values
-        }
-
-
-''' binaural beat '''
-# creating two slightly different sine waves for each ear
-# base frequency in Hz 
-def play_leftbinaural(base_freq):
-    left = Sine(freq=base_freq, mul=0.5).out()
-    return left
-
-# binaural freq. for anxiety/stress relief, alpha freq. lie between 8-13Hz
-def play_rightbinaural(base_freq,binaural_freq):    
-    right = Sine(freq=base_freq + binaural_freq, mul=1).out()
-    return right 
-
-
-''' QRS sonification '''
-# function to map QRS data to a melody 
-def mapping(qrs_data, notes=[60,62,64,65,67,69,71,72]):
-    events=[]
-    for item in qrs_data:
-        # 8 notes, 0.1-0.005/8=0.011875
-        if item <= 0.125:
-            events.append(notes[0])
-        elif 0.125 < item <= 0.25:
-            events.append(notes[1])
-        elif 0.25 < item <= 0.375:
-            events.append(notes[2])
-        elif 0.375 < item <= 0.5:
-            events.append(notes[3])
-        elif 0.5 < item <= 0.625:
-            events.append(notes[4])
-        elif 0.625 < item <= 0.75:
-            events.append(notes[5])
-        elif 0.75 < item <= 0.875:
-            events.append(notes[6])
-        elif 0.875 < item <= 1:
-            events.append(notes[7])
-        else: 
-            events.append(notes[4]) # median duration
-    return events
-
-# used to convert notes to their corresponding frequency 
-def midiToHz(midi_note):
-    return 440 * 2 ** ((midi_note - 69) / 12)
-
-# synthesises the final melody  
-def playQRS(melody_events):
-    global osc
-    for note in melody_events:
-        freq = midiToHz(note)
-        osc= Sine(freq=freq, mul=0.5)
-    return osc
-
-
-''' gong sounds '''
-def gongSounds(data):
-    rr_intervals = [value + 3.5 for value in data['RR Values']]
-    rr_mean = np.mean(data['RR Values'])
-    rr_sd = np.std(data['RR Values'])
-
-    # path to the gong sound file
-    gong_file_path = "sounds/gong.wav"
-
-    # metro objects + counter definition 
-    gong_met_time = SigTo(rr_intervals[0], time=float(rr_mean))
-    gong_met = Metro(time=gong_met_time).out()
-    beat_count_gong = Counter(gong_met)
-
-
-    # function to update Metro time
-    def update_gong_met():
-        next_interval = rr_intervals[int(beat_count_gong.get()) % len(rr_intervals)]
-        gong_met_time.setValue(next_interval)
-        gong_met.setTime(next_interval)
-        xfade.play()
-        gong_player.out()
-
-    gong_player = SfPlayer(gong_file_path, speed=1.5, mul=0.5, loop=False)
-    trig_update_gongmet = TrigFunc(gong_met, update_gong_met)
-    gong_reverb = Freeverb(gong_player.mix(2), size=0.9, damp=0.4, bal=0.4).out()
-    xfade = Fader(fadein=0.5, fadeout=0.5, dur=0, mul=1) # crossfade envelope
-
-    return trig_update_gongmet
-
-''' chime sounds '''
-def chimeSounds(data):
-    # path to the chime sound file
-    chime_file_path = "sounds/tinkle.wav"
-
-    # metro object to trigger 
-    chime_met_time = SigTo(value=1.75, time=0.1)  # smooth transition for metro time changes
-    chime_met = Metro(time=chime_met_time ).out() 
-
-    # counter to iterate over r_peaks
-    beat_count_chime = Counter(chime_met, min=0, max=len(data['R Peaks']) - 1)
-    # chime player
-    chime_player = SfPlayer(chime_file_path, speed=0.75, loop=False, mul=0)
-
-    # function to update amplitude based on r_peaks
-    def update_chime_amplitude():
-        idx = int(beat_count_chime.get())
-        amp  = float((data['R Peaks'])[idx])
-        chime_player.setMul(amp/100)  # update the amplitude
-        chime_player.out()
-
-    trig_update_amplitude = TrigFunc(chime_met, update_chime_amplitude)
-    return trig_update_amplitude
-
-
-''' process data '''
-data = signalProcessing(qrsdata,arr,offsets,times)
-
-''' play sounds '''
-# play binaural beat
-binaural_leftbeat = play_leftbinaural(base_freq=40).out()
-binaural_rightbeat = play_rightbinaural(base_freq=40, binaural_freq=8).out()
-
-# map QRS data to melody events + play QRS sounds 
-melody_events = mapping(data['QRS Durations'], notes=[60,62,64,65,67,69,71,72])
-QRS_sonified = playQRS(melody_events).out()
-
-# play gong sounds
-gong_sounds = gongSounds(data).out()
-
-# play chime sounds
-chime_sounds = chimeSounds(data).out()
-s.gui(locals())
-
-
-    
-
-
-
-
-
-
-
+def melodyWindows(path_qrs, span=WINDOW_SPAN):
+    """ Process the recording in windows of span seconds, as the online
+    application does; returns the (ecgdata, rrdata) of each window, with 
+    the heart rates taken from the R peaks that the detector finds """
+    # samples of all ecg frames in one array; frame i is arr[offsets[i]:offsets[i+1]]
+    arr, offsets, times = load_ecg(path_qrs)
+
+    # window of each ecg frame, counted from the first frame
+    span_ns = int(span*1e9)
+    ecg_window = (times-times[0])//span_ns
+
+    windows = []
+    last = None
+    last_peak = None
+    for index in np.unique(ecg_window):
+        frames = np.flatnonzero(ecg_window == index)
+        # the detector starts again with each recording, and after gaps in 
+        # the recording
+        reset = last == None or index != last+1
+        last = index
+        if reset:
+            last_peak = None
+        position = offsets[frames[0]]
+        samples = arr[position:offsets[frames[-1]+1]]
+        processed_ecg_data = ecg_signalprocessing(samples, reset, 
+                                                  SAMPLING_RATE)
+
+        # heart rate (bpm) of each beat, from the interval since the R peak 
+        # before it, which can be in the previous window; peaks are relative 
+        # to the window, and negative for beats confirmed one window late, so
+        # this gives their true sample positions
+        peaks = position+np.asarray(processed_ecg_data["R Peaks"], dtype=int)
+        if last_peak != None:
+            peaks = np.concatenate(([last_peak], peaks))
+        heart_rates = 60*SAMPLING_RATE/np.diff(peaks)
+        if len(peaks):
+            last_peak = peaks[-1]
+        windows.append((processed_ecg_data, rr_signalprocessing(heart_rates)))
+    return windows
+
+
+def main():
+    windows = melodyWindows(file_path_qrs)
+    print(f"{len(windows)} windows to sonify")
+
+    if RENDER != None:
+        speedup = render(windows, RENDER, span=WINDOW_SPAN)
+        print(f"Rendered to {RENDER}, {speedup:.1f}x faster than real time")
+        return
+
+    ''' play sounds '''
+    s = Server().boot().start()
+    engine = SonificationEngine(s)
+    player = play_windows(engine, windows, span=WINDOW_SPAN)
+    s.gui(locals())
+
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,6 @@ import sys
 import asyncio
 import numpy as np
 import pandas as pd
-import neurokit2 as nk
-import re
 import tkinter as tk
 import tk_async_execute as tae
 
@@ -25,27 +23,67 @@ from bleak import BleakScanner, BleakClient
 # Allow importing bleakheart from parent directory
 sys.path.append('../')
 from bleakheart import PolarMeasurementData 
-from bleakheart import HeartRate
+from bleakheart import HeartRate, Instrumentation
+from devicecache import DeviceCache, CACHE_PATH, find_device
+from reconnect import supervise, wait_any, gap_marker
+from framelog import FrameRecorder
+from merger import StreamMerger, WindowAccumulator, feed
+from sonification import SonificationEngine
+from signalprocessing import ProcessingStage, ecg_signalprocessing, rr_signalprocessing, ppi_signalprocessing
 
 # INSTANT_RATE is unsupported when UNPACK is False
 UNPACK = True
 INSTANT_RATE= UNPACK and True
 
-
-
-async def scan():
-    """ Scan for a Polar device. """
-    device= await BleakScanner.find_device_by_filter(
-        lambda dev, adv: dev.name and "polar" in dev.name.lower())
+# set REPLAY to a recording, e.g. 'testdata/[1]/02', to stream it through 
+# the pipeline instead of a sensor (no Bluetooth needed). REPLAY_SPEED is a
+# multiple of real time; None replays as fast as possible. Windows span 
+# WINDOW_SPAN seconds of replay time, so each holds more of the recording at 
+# higher speeds
+REPLAY = None
+REPLAY_SPEED = 1.0
+if REPLAY != None:
+    from blereplay import replay_backend
+    BleakScanner, BleakClient = replay_backend(REPLAY, speed=REPLAY_SPEED)
+# BEAT_SOURCE selects where heartbeats come from: 'ECG' detects R peaks in
+# the ECG of a chest strap (Polar H10); 'PPI' uses the peak-to-peak 
+# intervals computed by optical sensors (Polar Verity Sense, OH1), which 
+# skips ECG processing altogether. The QRS melody needs ECG, so it is 
+# silent with 'PPI'
+BEAT_SOURCE = 'ECG'
+# frames are processed in windows of WINDOW_SPAN seconds (about 10 ECG 
+# frames); a stream with no new frames, e.g. no heartbeats, holds back a
+# window for at most WINDOW_LATENESS seconds
+WINDOW_SPAN = 5.6
+WINDOW_LATENESS = 2.0
+# ecg processing runs in a 'thread' or 'process' pool, so that it does not hold
+# up the event loop; at most PROCESSING_IN_FLIGHT windows wait or run at once 
+PROCESSING_EXECUTOR = 'thread'
+PROCESSING_IN_FLIGHT = 2
+# set INSTRUMENT to True to print the latency of the bleakheart handlers and
+# of the queues after each processed window
+INSTRUMENT = False
+# set RECORD to a file name, e.g. 'session.bhlog', to log the raw sensor 
+# frames for later analysis (see framelog.py)
+RECORD = None
+
+
+
+async def scan(cache):
+    """ Look for the last used Polar device; scan for any Polar device
+    if it is not around. """
+    device= await find_device(cache, BleakScanner)
     return device
 
 
 
-async def run_ble_client(device, ecgqueue,hrqueue):
+async def run_ble_client(device, ecgqueue,hrqueue,cache,instrument):
     """ This task connects to the BLE server (the heart rate sensor)
     identified by device, starts ECG notification and pushes the ECG 
-    data to the queue. The tasks terminates when the sensor disconnects 
-    or the user hits enter. """
+    data to the queue. If the sensor disconnects, a gap marker is pushed
+    to both queues and the task reconnects, with increasing delays, while
+    the consumer keeps running. The task terminates when the user hits 
+    enter. """
     
     def keyboard_handler():
         """ Called by the asyncio loop when the user hits Enter """
@@ -54,60 +92,91 @@ async def run_ble_client(device, ecgqueue,hrqueue):
         quitclient.set() # causes the ble client task to exit
 
     
-    def disconnected_callback(client):
-        """ Called by BleakClient if the sensor disconnects """
-        print("Sensor disconnected")
-        quitclient.set() # causes the ble client task to exit
+    def on_gap(tstamp):
+        """ Called by supervise after the sensor disconnects """
+        # mark the discontinuity so that processing does not join data 
+        # from either side of it
+        ecgqueue.put_nowait(gap_marker(3, tstamp))
+        hrqueue.put_nowait(gap_marker(4, tstamp))
+
+
+    async def session(disconnected):
+        """ One connection to the sensor; returns when the sensor
+        disconnects or the user hits enter """
+
+        def disconnected_callback(client):
+            """ Called by BleakClient if the sensor disconnects """
+            print("Sensor disconnected")
+            disconnected.set() # causes the session to end
+
+        print(f"Connecting to {device}...")
+
+        # the context manager will handle connection/disconnection for us
+        async with BleakClient(device, disconnected_callback=
+                               disconnected_callback) as client:
+            print(f"Connected: {client.is_connected}")
+
+
+            pmd=PolarMeasurementData(client, ecg_queue=ecgqueue, ecg_array=True,
+                                     ppi_queue=ecgqueue,
+                                     drift_correction=True, recorder=recorder,
+                                     instrument=instrument) # create the Polar Measurement Data object; set queue for ecg data (decoded as numpy arrays, time stamps corrected for clock drift), which PPI data takes over when it is the beat source
+            # ask about the settings, unless they are known from a previous session
+            settings=cache.settings(BEAT_SOURCE)
+            if settings==None:
+                settings=await pmd.available_settings(BEAT_SOURCE)
+                cache.remember_settings(BEAT_SOURCE, settings)
+            print(f"Available {BEAT_SOURCE} settings:")
+            for k,v in settings.items():
+                print(f"{k}:\t{v}")
+
+            heartrate = HeartRate(client, queue=hrqueue,
+                        instant_rate=INSTANT_RATE,
+                        unpack=UNPACK, recorder=recorder,
+                        instrument=instrument)
+            
+            # start notifications for ecg (or ppi); bleakheart will start pushing data to the queue we passed to PolarMeasurementData
+            (err_code, err_msg, _)= await pmd.start_streaming(BEAT_SOURCE)
+            if err_code!=0:
+                print(f"PMD returned an error: {err_msg}")
+                sys.exit(err_code)
+          
+            # start notifications for hr; bleakheart will start pushing data to the queue
+            # (PPI frames carry the beat intervals, so hr is not needed with them)
+            if BEAT_SOURCE == 'ECG':
+                await heartrate.start_notify()
+
+            await wait_any(quitclient, disconnected)
+            if client.is_connected:
+                await pmd.stop_streaming(BEAT_SOURCE)
+                if BEAT_SOURCE == 'ECG':
+                    await heartrate.stop_notify()
 
 
     # we use this event to signal the end of the client task
     quitclient=asyncio.Event()
-    print(f"Connecting to {device}...")
-
-    # the context manager will handle connection/disconnection for us
-    async with BleakClient(device, disconnected_callback=
-                           disconnected_callback) as client:
-        print(f"Connected: {client.is_connected}")
+    # one log for the whole run, across reconnections
+    recorder=FrameRecorder(RECORD) if RECORD != None else None
 
+    # Set the loop to call keyboard_handler when one line of input is
+    # ready on stdin
+    loop=asyncio.get_running_loop()
+    loop.add_reader(sys.stdin, keyboard_handler)
+    print(">>> Hit Enter to exit <<<")
 
-        pmd=PolarMeasurementData(client, ecg_queue=ecgqueue) # create the Polar Measurement Data object; set queue for ecg data
-        settings=await pmd.available_settings('ECG')  # ask about ACC settings
-        print("Request for available ECG settings returned the following:")
-        for k,v in settings.items():
-            print(f"{k}:\t{v}")
-
-        # Set the loop to call keyboard_handler when one line of input is
-        # ready on stdin
-        loop=asyncio.get_running_loop()
-        loop.add_reader(sys.stdin, keyboard_handler)
-        print(">>> Hit Enter to exit <<<")
-
-        heartrate = HeartRate(client, queue=hrqueue,
-                    instant_rate=INSTANT_RATE,
-                    unpack=UNPACK)
-        
-        # start notifications for ecg; bleakheart will start pushing data to the queue we passed to PolarMeasurementData
-        (err_code, err_msg, _)= await pmd.start_streaming('ECG')
-        if err_code!=0:
-            print(f"PMD returned an error: {err_msg}")
-            sys.exit(err_code)
-      
-        # start notifications for hr; bleakheart will start pushing data to the queue
-        await heartrate.start_notify()
+    # connect, and reconnect whenever the sensor drops out
+    await supervise(session, quitclient, on_gap=on_gap)
+    loop.remove_reader(sys.stdin)
+    if recorder != None:
+        recorder.close()
 
-        await quitclient.wait()
-        if client.is_connected:
-            await pmd.stop_streaming('ECG')
-            await heartrate.stop_notify()
-        loop.remove_reader(sys.stdin)
+    # signal the consumer task to quit
+    ecgqueue.put_nowait(('QUIT', None, None, None))
+    hrqueue.put_nowait(('QUIT', None, None, None))
 
-        # signal the consumer task to quit
-        ecgqueue.put_nowait(('QUIT', None, None, None))
-        hrqueue.put_nowait(('QUIT', None, None, None))
 
 
-
-async def run_consumer_task(ecgqueue,hrqueue):
+async def run_consumer_task(ecgqueue,hrqueue,instrument):
     """ This task retrieves ECG data from the queue and does 
     all the processing. You should ensure it returns control before 
     the next frame is received from the sensor. 
@@ -119,52 +188,79 @@ async def run_consumer_task(ecgqueue,hrqueue):
     print("where samples s1,...sn are in microVolt, tstamp is in ns")
     print("and it refers to the last sample sn.")
 
-    ecg_frames_list = [] 
-    hr_frames_list = []
-    
 
     s = Server().boot()
     s.deactivateMidi()
     s.boot()
     s.start()
 
+    # the voices of the melody are built once; each window updates them
+    engine = SonificationEngine(s)
+
 
+    # one task for each stream moves frames from its queue to the merger, 
+    # which hands out windows holding the frames of both streams for the 
+    # same stretch of time, so neither stream can stall the other
+    streams = ['ecg', 'hr'] if BEAT_SOURCE == 'ECG' else ['ecg']
+    merger = StreamMerger(streams, span=WINDOW_SPAN, lateness=WINDOW_LATENESS)
+    feeders = [asyncio.create_task(feed(ecgqueue, merger, 'ecg', instrument))]
+    if BEAT_SOURCE == 'ECG':
+        feeders.append(asyncio.create_task(feed(hrqueue, merger, 'hr', instrument)))
+
+    # r peak detection runs in a single worker, which keeps the detector state 
+    # from one window to the next
+    stage = ProcessingStage(PROCESSING_EXECUTOR, max_in_flight=PROCESSING_IN_FLIGHT)
+    last_end = None
+
+    # frame payloads are copied into preallocated arrays; a buffer of ecg samples 
+    # must outlive the windows in processing, hence the depth
+    ecgaccumulator = WindowAccumulator(capacity=1024, depth=PROCESSING_IN_FLIGHT+1)
+    hraccumulator = WindowAccumulator(capacity=64, select=lambda frame: frame[2][0])
 
     while True:
-        # get ecg/hr frames from ble_client
-        ecg_frame = await ecgqueue.get()
-        hr_frame = await hrqueue.get()
-        
-        # intercept exit signal
-        if (ecg_frame[0]=='QUIT'):   
+        # get the next window of ecg/hr frames; None once the ble client quits
+        window = await merger.get()
+        if window == None:
             break
 
-        # continuosly append frames to individual lists 
-        ecg_frames_list.append(ecg_frame)
-        hr_frames_list.append(hr_frame)
-        
-        # once lists reach a big enough size, allow them to undergo signal processing
-        if (len(ecg_frames_list) >= 10) and (len(hr_frames_list) >= 10): 
+        ecg_frames_list = window.frames['ecg']
+        # with PPI as the beat source, the intervals come with the ppi frames
+        hr_frames_list = window.frames.get('hr', ecg_frames_list)
 
-            # create asynchronus tasks to run signal processing on both ecg&hr frames
-            ecg_processing = asyncio.create_task(ecg_signalprocessing(ecg_frames_list))
-            rr_processing = asyncio.create_task(rr_signalprocessing(hr_frames_list))
+        # nothing to sonify without both ecg and heartbeats
+        if not ecg_frames_list or not hr_frames_list:
+            continue
 
-            # await data processing 
-            processed_ecg_data = await ecg_processing
-            processed_rr_data = await rr_processing
+        if BEAT_SOURCE == 'PPI':
+            # beats come from the sensor, no ecg to process
+            processed_ecg_data, processed_rr_data = ppi_signalprocessing(ecg_frames_list)
+            if len(processed_rr_data["RR Intervals"]) == 0:
+                # every beat in the window was flagged as unreliable
+                continue
 
-            # create asynchronus task to run melody generation system in the background 
-            melodygenerator = asyncio.create_task(melodyGeneration(s,processed_ecg_data,processed_rr_data))
+            engine.update(processed_ecg_data, processed_rr_data)
+        else:
+            # windows that do not follow on from the last one come after a gap 
+            reset = last_end != None and window.start != last_end
+            last_end = window.end
 
-            # give the melodygeneration background task some time to start running 
-            await asyncio.sleep(0)   
-        
+            # hand the ecg to the worker; this waits if too many windows are in flight
+            samples = ecgaccumulator.gather(ecg_frames_list)
+            ecg_processing = await stage.submit(ecg_signalprocessing, samples, reset)
+            processed_rr_data = rr_signalprocessing(hraccumulator.gather(hr_frames_list))
+
+            # create asynchronus task to play the window once its ecg is processed 
+            melodygenerator = asyncio.create_task(sonify(engine, ecg_processing, processed_rr_data))
 
-            # clear the lists once signal processing is complete
-            ecg_frames_list.clear()
-            hr_frames_list.clear()
+        # give the sonify background task some time to start running 
+        await asyncio.sleep(0)   
+
+        if instrument != None:
+            print(instrument.report())
     
+    await asyncio.gather(*feeders)
+    stage.close()
+    engine.stop()
     # as opposed to using 's.gui.locals()'
     sigwait([SIGINT])
     s.stop()
@@ -175,239 +271,36 @@ async def run_consumer_task(ecgqueue,hrqueue):
         
 async def main():    
     print("Scanning for BLE devices")
-    device=await scan()
+    # a replay must not replace the sensor on file
+    cache=DeviceCache(None if REPLAY != None else CACHE_PATH)
+    device=await scan(cache)
     if device==None:
         print("Polar device not found.")
         sys.exit(-4)
     # the queue needs to be long enough to cache all the frames, since
-    # PolarMeasurementData uses put_nowait
+    # PolarMeasurementData uses put_nowait (ringbuffer.RingBuffer can be
+    # passed instead if memory must stay bounded)
     ecgqueue=asyncio.Queue()
     hrqueue=asyncio.Queue()
 
     # producer task will return when the user hits enter or the
     # sensor disconnects
-    producer=run_ble_client(device, ecgqueue,hrqueue)
-    consumer=run_consumer_task(ecgqueue, hrqueue)
+    instrument=Instrumentation() if INSTRUMENT else None
+    producer=run_ble_client(device, ecgqueue,hrqueue,cache,instrument)
+    consumer=run_consumer_task(ecgqueue, hrqueue, instrument)
 
 
     # wait for the two tasks to exit
     await asyncio.gather(producer, consumer)
     print("Bye.")
 
-async def rr_signalprocessing(data):
-    # declare empty array 'arr' to store final values 
-    arr=np.array([])
-
-    # clean, convert and standardise values
-    clean_rr_data = re.sub(r'[^\d.\s]', '', str([rrdata[0] for label, timestamp, rrdata,none in data]))
-    conversion = np.array([float(num) for num in clean_rr_data.split()])
-
-    # add values to 'arr' 
-    arr = np.append(arr,conversion)
-
-    # return values as dictionary for accessibilitty 
-    return {
-        "RR Intervals": arr
-        } 
-
-async def ecg_signalprocessing(data):
-    # declare empty array 'arr' to store final values 
-    arr=np.array([])
-
-    # clean, convert and standardise values
-    clean_ecg_data =  re.sub(r'[^\d.\s]', '', str([ecgdata for label, timestamp, ecgdata in data]))
-    conversion = np.array([float(num) for num in clean_ecg_data.split()])
-
-    # create numpy arrays that contain data and timestamps seperately 
-    arr = np.append(arr,conversion)
-
-    # assign value to sampling rate + process signals using neurokit package 
-    samplingrate=50 
-    signals, info = nk.ecg_process(arr, sampling_rate=samplingrate,method='neurokit')
-
-    qrs_durations = []
-    r_peaks = info['ECG_R_Peaks']
-    q_peaks = info['ECG_Q_Peaks']
-    s_peaks = info['ECG_S_Peaks']
-
-    # qrs duration processing 
-    for r in r_peaks:
-        # find the nearest Q and S peaks around each R peak
-        q = max([q for q in q_peaks if q < r], default=None)
-        s = min([s for s in s_peaks if s > r], default=None)
-
-        if q is not None and s is not None:
-            # calculate the QRS duration in terms of samples
-            qrs_duration_samples = s - q
-
-            # convert samples to time using sampling rate formula
-            qrs_duration_seconds = qrs_duration_samples / samplingrate  # sampling rate
-            qrs_durations.append(qrs_duration_seconds)
-
-    # return items as dictionary for accessibility 
-    return{
-        "R Peaks": r_peaks,
-        "Q Peaks": q_peaks,
-        "S Peaks": s_peaks,
-        "QRS Durations": qrs_durations
-        }
-
-
-async def melodyGeneration(s,ecgdata,rrdata):
-    osc= Sine()
-    
-    ''' binaural beat '''
-    # creating two slightly different sine waves for each ear
-    # base frequency in Hz 
-    def play_leftbinaural(base_freq):
-        left = Sine(freq=base_freq, mul=0.3).out()
-        return left
-
-    # binaural freq. for anxiety/stress relief, alpha freq. lie between 8-13Hz
-    def play_rightbinaural(base_freq,binaural_freq):    
-        right = Sine(freq=base_freq + binaural_freq, mul=0.4).out()
-        return right 
-
-
-    ''' QRS sonification '''
-    # function to map QRS data to a melody 
-    def mapping(qrs_data, notes=[60,62,64,65,67,69,71,72]):
-        events=[]
-        for item in qrs_data:
-            # 8 notes, 0.1-0.005/8=0.011875
-            if item <= 0.125:
-                events.append(notes[0])
-            elif 0.125 < item <= 0.25:
-                events.append(notes[1])
-            elif 0.25 < item <= 0.375:
-                events.append(notes[2])
-            elif 0.375 < item <= 0.5:
-                events.append(notes[3])
-            elif 0.5 < item <= 0.625:
-                events.append(notes[4])
-            elif 0.625 < item <= 0.75:
-                events.append(notes[5])
-            elif 0.75 < item <= 0.875:
-                events.append(notes[6])
-            elif 0.875 < item <= 1:
-                events.append(notes[7])
-            else: 
-                events.append(notes[4]) # median duration
-        return events
-
-    # used to convert notes to their corresponding frequency 
-    def midiToHz(midi_note):
-        return 440 * 2 ** ((midi_note - 69) / 12)
-
-    # synthesises the final melody  
-    def playQRS(ecgdata):
-        melody_events = mapping(ecgdata['QRS Durations'], notes=[60,62,64,65,67,69,71,72])
-        global osc
-        for note in melody_events:
-            freq = midiToHz(note)
-            osc= Sine(freq=freq, mul=0.2)
-        return osc.out()
-
-
-    ''' gong sounds '''
-    def gongSounds(s,data):
-        rr_intervals = data["RR Intervals"]
-        initial = rr_intervals[0]
-
-        print (rr_intervals)
-        # path to the gong sound file
-        gong_file_path = "sounds/gong.wav"
-
-        # metro objects + counter definition 
-        gong_met_time = SigTo(float(initial), time=float(initial/10))
-        gong_met = Metro(time=gong_met_time).out()
-
-        beat_count_gong = Counter(gong_met,min=0, max=len(rr_intervals))
-        gong_player = SfPlayer(gong_file_path, speed=1.5, mul=0.5, loop=False)
-
-        # function to update Metro time
-        def update_gong_met():
-            idx = int(beat_count_gong.get())
-            print ("updating time: ", rr_intervals[idx]/10, ",comparison: ", idx, " vs", len(rr_intervals)-1)
-            if idx == (len(rr_intervals)-1):
-                print ("gong data has run out!!")
-                gong_player.stop()  # Stop playing once all intervals are processed
-                gong_met.stop()  # Stop the metro object
-                s.stop()
-                #raise EarlyReturnException("Early exit from gongSounds.") 
-        
-            else:
-                next_interval = float(rr_intervals[idx]/10)
-                gong_met_time.setValue(next_interval)
-                gong_met.setTime(next_interval)
-                xfade.play()
-                gong_reverb.play()
-                gong_player.out()
-
-
-        gong_reverb = Freeverb(gong_player.mix(2), size=0.9, damp=0.4, bal=0.4)
-        xfade = Fader(fadein=0.5, fadeout=0.5, dur=0, mul=1) # crossfade envelope
-        trig_update_gongmet = TrigFunc(gong_met, update_gong_met)
-
-        return trig_update_gongmet
-
-    ''' chime sounds '''
-    def chimeSounds(data):
-        print (data["R Peaks"])
-        # path to the chime sound file
-        chime_file_path = "sounds/tinkle.wav"
-
-        # metro object to trigger 
-        chime_met_time = SigTo(value=1.75, time=0.1)  # smooth transition for metro time changes
-        chime_met = Metro(time=chime_met_time).out() 
-
-        # counter to iterate over r_peaks
-        beat_count_chime = Counter(chime_met, min=0, max=len(data['R Peaks']))
-    
-        # chime player
-        chime_player = SfPlayer(chime_file_path, speed=0.75, loop=False, mul=0)
-
-        # function to update amplitude based on r_peaks
-        def update_chime_amplitude():
-            idx = int(beat_count_chime.get())
-            print ("updating amplitude: ", data['R Peaks'][idx], ",comparison: ", idx, " vs", len(data['R Peaks'])-1)
-            if idx == (len(data['R Peaks'])-1):
-                print ("chime data has run out!!")
-                chime_met.stop()  # Stop the metro object when data runs out
-                print ("chime is returning")
-                return 
-
-            else:
-                amp = float(data['R Peaks'][idx])
-                chime_player.setMul(amp / 100)  # update the amplitude
-                chime_player.out()
-        trig_update_amplitude = TrigFunc(chime_met, update_chime_amplitude)
-
-        return trig_update_amplitude 
-
-    
-    def playSounds(s,ecgdata,rrdata):
-        print ("reached starting point!")
-
-        ''' play sounds '''
-        # play binaural beat
-        binaural_leftbeat = play_leftbinaural(base_freq=40)
-        binaural_rightbeat = play_rightbinaural(base_freq=40, binaural_freq=8)
-
-        # map QRS data to melody events + play QRS sounds 
-        QRS_sonified = playQRS(ecgdata)
-
-        # play gong sounds
-        gong_sounds = gongSounds(s,rrdata)
-
-        # play chime sounds
-        chime_sounds = chimeSounds(ecgdata)
-
-        print ("reached end")
-        
-        return gong_sounds, chime_sounds, binaural_leftbeat, binaural_rightbeat,QRS_sonified
-
-    return playSounds(s,ecgdata,rrdata)
+async def sonify(engine, ecg_processing, rrdata):
+    """ Wait for the ecg of a window to be processed, then play the window """
+    ecgdata = await ecg_processing
+    if len(ecgdata["R Peaks"]) == 0:
+        # no beat confirmed yet, e.g. while the detector learns its thresholds
+        return
+    engine.update(ecgdata, rrdata)
 
 
 asyncio.run(main())
@@ -0,0 +1,88 @@
+""" Supervised sensor connection: reconnect with backoff after a drop.
+
+supervise() keeps a streaming session running until the user quits: when
+the sensor disconnects (or connecting fails) it reports a gap, waits an
+increasing delay and starts the session again, while the consumer and
+the audio engine keep running. Gap markers are frames of the form
+    ('GAP', tstamp)
+padded with None to the length of the frames of each stream, so that
+downstream processing can avoid splicing data across the discontinuity.
+"""
+
+import asyncio as aio
+from time import time_ns
+
+
+class Backoff:
+    """ Exponential backoff: delays of initial, initial*factor, ... up to
+    maximum seconds """
+
+    def __init__(self, initial=0.5, factor=2.0, maximum=30.0):
+        self.initial=initial
+        self.factor=factor
+        self.maximum=maximum
+        self.reset()
+
+    def reset(self):
+        """ Start again from the initial delay """
+        self._delay=self.initial
+
+    def next(self):
+        """ The delay before the next attempt, in seconds """
+        delay=self._delay
+        self._delay=min(self._delay*self.factor, self.maximum)
+        return delay
+
+
+async def wait_any(*events):
+    """ Wait until at least one of the asyncio events is set """
+    waiters=[aio.create_task(event.wait()) for event in events]
+    try:
+        await aio.wait(waiters, return_when=aio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+def gap_marker(length, tstamp=None):
+    """ A gap marker frame with the given number of elements """
+    tstamp=time_ns() if tstamp==None else tstamp
+    return ('GAP', tstamp)+(None,)*(length-2)
+
+
+async def supervise(session, quit_event, on_gap=None, backoff=None):
+    """ Run a streaming session until quit_event is set, reconnecting
+    after every disconnection.
+
+    Args:
+        session: a coroutine function taking an asyncio Event. It must
+            connect to the sensor, start streaming and return once 
+            quit_event or the event it was passed (to be set by the
+            disconnected callback) is set. Failures are reported by 
+            raising an exception
+        quit_event: asyncio Event that ends supervision
+        on_gap: function called with the time stamp (in ns) of each
+            disconnection, e.g. to push gap markers to the queues
+        backoff: a Backoff object; by default 0.5 s doubling up to 30 s
+    """
+    backoff=Backoff() if backoff==None else backoff
+    while not quit_event.is_set():
+        disconnected=aio.Event()
+        started=time_ns()
+        try:
+            await session(disconnected)
+        except Exception as e:
+            print(f"Sensor connection failed: {e!r}")
+        if quit_event.is_set():
+            break
+        if on_gap!=None:
+            on_gap(time_ns())
+        if time_ns()-started>60*1000000000:
+            # the connection had been up for a while: retry quickly
+            backoff.reset()
+        delay=backoff.next()
+        print(f"Reconnecting in {delay:.1f} s")
+        try:
+            await aio.wait_for(quit_event.wait(), timeout=delay)
+        except aio.TimeoutError:
+            pass
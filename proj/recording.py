@@ -0,0 +1,138 @@
+""" Loading of recorded ECG sessions.
+
+Recordings are csv files with a 'time' column (host time stamp of the
+frame in ns) and an 'ecg' column holding the samples of each frame as a
+stringified list, e.g. "[5383, 5892, 6415]". load_ecg_csv() parses the
+whole column in one vectorized pass into a single int32 array of
+samples, with the offset of each frame in it and the frame time stamps:
+the samples of frame i are samples[offsets[i]:offsets[i+1]].
+
+The same three arrays can be stored in a binary bundle (convert_ecg_csv,
+or run this module on csv files), laid out as
+    8-byte magic | uint64 frames | uint64 samples
+    int64 times[frames] | int64 offsets[frames+1] | int32 samples[samples]
+little-endian. load_ecg_bundle() memory-maps the bundle and returns views
+on it, so opening a recording costs the same whatever its length, and
+only the parts that are used are read from disk. load_ecg() takes
+either format.
+
+Convert recordings from this directory with:
+    python recording.py testdata/[1]/02ecgdata.csv ...
+"""
+
+import re
+import os
+import sys
+import csv
+import struct
+import numpy as np
+
+_BRACKETS=str.maketrans('[]', '  ')
+
+MAGIC=b'ECGBNDL1'
+HEADER=struct.Struct('<8sQQ')
+BUNDLE_SUFFIX='.ecgb'
+
+
+def parse_ecg_column(values):
+    """ Parse stringified sample lists.
+
+    Args:
+        values: sequence of strings such as "[5383, 5892, 6415]", one
+            for each frame; every frame holds at least one sample
+
+    Returns:
+        (samples, offsets): the samples of all frames as one int32 array,
+        and an int64 array with the offset of each frame in it, plus the
+        total number of samples as last element
+    """
+    text=','.join(values)
+    if re.search(r'\[\s*\]', text):
+        raise ValueError("ECG frame with no samples")
+    # the sample index of the first sample of a frame is the number of
+    # commas before its opening bracket
+    chars=np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    commas=np.flatnonzero(chars==ord(','))
+    offsets=np.empty(len(values)+1, dtype=np.int64)
+    offsets[:-1]=np.searchsorted(commas, np.flatnonzero(chars==ord('[')))
+    offsets[-1]=len(commas)+1 if len(chars) else 0
+    samples=np.fromstring(text.translate(_BRACKETS), dtype=np.int32, sep=',')
+    if len(samples)!=offsets[-1] or np.any(np.diff(offsets)<=0):
+        raise ValueError("Malformed ECG sample lists")
+    return samples, offsets
+
+
+def load_ecg_csv(path):
+    """ Load a recorded ECG csv file.
+
+    Returns:
+        (samples, offsets, times): the samples and frame offsets as
+        returned by parse_ecg_column, and the time stamp of each frame
+        in ns (int64)
+    """
+    with open(path, newline='') as csv_file:
+        reader=csv.reader(csv_file)
+        header=next(reader)
+        time_column, ecg_column=header.index('time'), header.index('ecg')
+        rows=list(reader)
+    samples, offsets=parse_ecg_column([row[ecg_column] for row in rows])
+    times=np.array([row[time_column] for row in rows], dtype=np.int64)
+    return samples, offsets, times
+
+
+def write_ecg_bundle(path, samples, offsets, times):
+    """ Write samples, offsets and times (as returned by load_ecg_csv) to
+    a binary bundle """
+    with open(path, 'wb') as bundle_file:
+        bundle_file.write(HEADER.pack(MAGIC, len(times), len(samples)))
+        np.ascontiguousarray(times, dtype='<i8').tofile(bundle_file)
+        np.ascontiguousarray(offsets, dtype='<i8').tofile(bundle_file)
+        np.ascontiguousarray(samples, dtype='<i4').tofile(bundle_file)
+
+
+def load_ecg_bundle(path):
+    """ Memory-map a binary bundle.
+
+    Returns:
+        (samples, offsets, times) as in load_ecg_csv, as read-only views
+        on the file
+    """
+    raw=np.memmap(path, dtype=np.uint8, mode='r')
+    if len(raw)<HEADER.size:
+        raise ValueError(f"{path} is not an ECG bundle")
+    magic, frames, nsamples=HEADER.unpack(raw[:HEADER.size].tobytes())
+    if magic!=MAGIC:
+        raise ValueError(f"{path} is not an ECG bundle")
+    start=HEADER.size
+    end=start+8*frames
+    times=raw[start:end].view('<i8')
+    start, end=end, end+8*(frames+1)
+    offsets=raw[start:end].view('<i8')
+    start, end=end, end+4*nsamples
+    samples=raw[start:end].view('<i4')
+    if end!=len(raw):
+        raise ValueError(f"{path} is truncated or corrupt")
+    return samples, offsets, times
+
+
+def load_ecg(path):
+    """ Load a recording from a binary bundle (memory-mapped) or from a
+    csv file, depending on the file name """
+    if path.endswith(BUNDLE_SUFFIX):
+        return load_ecg_bundle(path)
+    return load_ecg_csv(path)
+
+
+def convert_ecg_csv(path, bundle_path=None):
+    """ Convert a recorded ECG csv file to a binary bundle, by default
+    next to it with the extension BUNDLE_SUFFIX; returns the bundle 
+    path """
+    if bundle_path==None:
+        bundle_path=os.path.splitext(path)[0]+BUNDLE_SUFFIX
+    write_ecg_bundle(bundle_path, *load_ecg_csv(path))
+    return bundle_path
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(f"{path} -> {convert_ecg_csv(path)}")
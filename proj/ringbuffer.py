@@ -0,0 +1,232 @@
+""" Fixed-capacity, array-backed ring buffer for sensor samples.
+
+A RingBuffer can be passed to PolarMeasurementData or HeartRate in place
+of an asyncio queue: the sensor classes only call put_nowait. Instead of
+caching whole frames, the buffer stores individual samples (and their
+estimated time stamps) in preallocated NumPy arrays, so memory use stays
+constant however far the consumer falls behind.
+"""
+
+import asyncio as aio
+import numpy as np
+
+
+class RingBuffer:
+    """ Ring buffer of samples with a single reader.
+
+    Frames are accepted in the formats produced by bleakheart:
+        ('ECG', tstamp, samples)           one sample per list/array entry
+        ('ACC', tstamp, samples)           rows of (x,y,z), use width=3
+        ('HR', tstamp, (hr, rr), energy)   one (hr, rr) sample, use width=2
+        ('HR', tstamp, (avghr, rrlist), energy)  one (avghr, rr) sample
+                                           for each rr in rrlist
+    A ('QUIT', ...) frame closes the buffer and wakes up the reader; a
+    ('GAP', tstamp, ...) marker (see reconnect.py) records a discontinuity
+    in the stream, at the position given by the written attribute.
+
+    Every sample is stored with a time stamp in ns. For heart rate data
+    the time stamp of each beat is estimated from the RR intervals. PMD
+    frames that carry per-sample time stamps (see the sample_times option
+    of PolarMeasurementData) are stored with those; otherwise, since the
+    frame time stamp refers to the last sample, earlier samples are 
+    spaced by 1/sample_rate (if given) or share the frame time stamp.
+
+    Storage is mirrored: each sample is written twice, capacity samples
+    apart, so that any run of up to capacity consecutive samples can be
+    returned as a contiguous view without copying. Views remain valid
+    until the samples they refer to are overwritten; copy them if they
+    need to outlive that.
+
+    When a frame does not fit, the overflow policy decides what happens:
+        'drop_oldest': the oldest unread samples are overwritten
+        'drop_newest': samples that do not fit are discarded
+        'block':       put_nowait raises asyncio.QueueFull; await put()
+                       instead (e.g. pass callback=ring.put to the sensor
+                       class) to wait until the reader frees enough space
+
+    Attributes:
+
+    capacity: number of samples held by the buffer
+    dropped:  total number of samples lost to overflow
+    overruns: number of frames that could not be stored in full
+    written:  total number of samples accepted since creation
+    closed:   True once a QUIT frame has been received
+    gaps:     list of (position, tstamp) tuples, one per gap marker, where
+              position is the number of samples written before the gap
+    """
+    overflow_policies=['drop_oldest', 'drop_newest', 'block']
+
+    def __init__(self, capacity, width=None, dtype=np.int32,
+                 sample_rate=None, overflow='drop_oldest'):
+        """ Init the RingBuffer object.
+
+        Args:
+
+        capacity:    maximum number of samples held by the buffer
+        width:       number of values per sample (e.g. 3 for ACC, 2 for HR);
+                     None for scalar samples such as ECG
+        dtype:       NumPy type of the stored samples
+        sample_rate: sampling rate in Hz, used to estimate the time stamps
+                     of all but the last sample of a PMD frame
+        overflow:    one of the strings in overflow_policies
+        """
+        if capacity<=0:
+            raise ValueError("Ring buffer capacity must be positive")
+        if overflow not in self.overflow_policies:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.capacity=capacity
+        self.overflow=overflow
+        self.sample_rate=sample_rate
+        shape=(2*capacity,) if width==None else (2*capacity, width)
+        self._data=np.zeros(shape, dtype=dtype)
+        self._times=np.zeros(2*capacity, dtype=np.int64)
+        self.written=0
+        self._read=0 # total number of samples consumed or dropped
+        self.dropped=0
+        self.overruns=0
+        self.closed=False
+        self.gaps=[]
+        self._data_ready=aio.Event()
+        self._space_ready=aio.Event()
+
+    def __len__(self):
+        """ Number of samples available to the reader """
+        return self.written-self._read
+
+    def free(self):
+        """ Number of samples that can be stored without overflowing """
+        return self.capacity-len(self)
+
+    def _samples(self, frame):
+        """ Convert a bleakheart frame to arrays of samples and time
+        stamps """
+        label, tstamp, payload=frame[0], frame[1], frame[2]
+        if label=='HR':
+            hr, rr=payload
+            if np.isscalar(rr):
+                return (np.array([(hr, rr)], dtype=self._data.dtype),
+                        np.array([tstamp], dtype=np.int64))
+            samples=np.empty((len(rr), 2), dtype=self._data.dtype)
+            samples[:, 0]=hr
+            samples[:, 1]=rr
+            # the frame time stamp refers to the last beat
+            elapsed=np.cumsum(np.asarray(rr[:0:-1], dtype=np.int64))[::-1]
+            times=np.full(len(rr), tstamp, dtype=np.int64)
+            times[:-1]-=elapsed*1000000
+            return samples, times
+        samples=np.asarray(payload, dtype=self._data.dtype)
+        n=len(samples)
+        if len(frame)>3 and isinstance(frame[3], np.ndarray):
+            times=frame[3]
+        elif self.sample_rate:
+            # the time stamp refers to the last sample
+            steps=np.arange(n-1, -1, -1, dtype=np.int64)
+            times=tstamp-steps*round(1e9/self.sample_rate)
+        else:
+            times=np.full(n, tstamp, dtype=np.int64)
+        return samples, times
+
+    def _store(self, samples, times):
+        """ Write samples at the head of the buffer and at its mirror """
+        cap=self.capacity
+        n=len(samples)
+        start=self.written%cap
+        first=min(n, cap-start)
+        for pos, lo, hi in ((start, 0, first), (0, first, n)):
+            if hi>lo:
+                self._data[pos:pos+hi-lo]=samples[lo:hi]
+                self._data[pos+cap:pos+cap+hi-lo]=samples[lo:hi]
+                self._times[pos:pos+hi-lo]=times[lo:hi]
+                self._times[pos+cap:pos+cap+hi-lo]=times[lo:hi]
+        self.written+=n
+        self._data_ready.set()
+
+    def put_nowait(self, frame):
+        """ Store the samples in a frame, applying the overflow policy if
+        they do not fit. A QUIT frame closes the buffer. """
+        if frame[0]=='QUIT':
+            self.close()
+            return
+        if frame[0]=='GAP':
+            self.gaps.append((self.written, frame[1]))
+            return
+        samples, times=self._samples(frame)
+        n=len(samples)
+        if n>self.free():
+            if self.overflow=='block':
+                raise aio.QueueFull
+            self.overruns+=1
+            if self.overflow=='drop_newest':
+                n=self.free()
+                self.dropped+=len(samples)-n
+                samples, times=samples[:n], times[:n]
+            else:
+                if n>self.capacity:
+                    # only the most recent samples can survive; the others
+                    # count as written and immediately overwritten
+                    self.written+=n-self.capacity
+                    samples=samples[-self.capacity:]
+                    times=times[-self.capacity:]
+                    n=self.capacity
+                lost=n-self.free()
+                self._read+=lost
+                self.dropped+=lost
+        self._store(samples, times)
+
+    async def put(self, frame):
+        """ Store the samples in a frame. With the 'block' policy, wait
+        until the reader has freed enough space; other policies behave as
+        put_nowait. """
+        if self.overflow=='block' and frame[0] not in ('QUIT', 'GAP'):
+            n=len(self._samples(frame)[0])
+            if n>self.capacity:
+                raise ValueError("Frame larger than ring buffer capacity")
+            while self.free()<n and not self.closed:
+                self._space_ready.clear()
+                await self._space_ready.wait()
+            if self.closed:
+                return
+        self.put_nowait(frame)
+
+    def close(self):
+        """ Mark the end of the stream and wake up the reader """
+        self.closed=True
+        self._data_ready.set()
+        self._space_ready.set()
+
+    async def wait(self, n):
+        """ Wait until at least n samples are available to the reader or
+        the buffer is closed. Returns the number of available samples. """
+        if n>self.capacity:
+            raise ValueError("Cannot wait for more samples than the "
+                             "ring buffer capacity")
+        while len(self)<n and not self.closed:
+            self._data_ready.clear()
+            await self._data_ready.wait()
+        return len(self)
+
+    def read_nowait(self, n=None):
+        """ Consume up to n of the oldest unread samples (all of them if n
+        is None).
+
+        Returns:
+            A tuple (samples, times) of contiguous views on the buffer
+        """
+        n=len(self) if n==None else min(n, len(self))
+        start=self._read%self.capacity
+        self._read+=n
+        self._space_ready.set()
+        return (self._data[start:start+n], self._times[start:start+n])
+
+    async def read(self, n):
+        """ Wait until n samples are available and consume them. Fewer
+        samples are returned if the buffer is closed first. """
+        await self.wait(n)
+        return self.read_nowait(n)
+
+    def latest(self, n):
+        """ Views of the n most recent samples and their time stamps,
+        whether read or not; the read position is unchanged. """
+        n=min(n, self.capacity, self.written)
+        end=self.written%self.capacity+self.capacity
+        return (self._data[end-n:end], self._times[end-n:end])
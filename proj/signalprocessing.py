@@ -0,0 +1,350 @@
+""" Incremental ECG processing for the online pipeline.
+
+StreamingPeakDetector finds R peaks (and the Q and S points around them)
+in an ECG stream delivered in chunks of any size, following Pan and
+Tompkins (IEEE Trans. Biomed. Eng. 32(3), 1985): band-pass filter,
+derivative, squaring and moving-window integration, then adaptive signal
+and noise thresholds with a refractory period and search-back for missed
+beats. Filter state, thresholds and a short tail of the signal are kept
+between calls, so peaks near the edges of a chunk are neither lost nor
+reported twice, and the cost of each call is proportional to the new
+samples only.
+
+The processing functions of the online scripts live here too, as plain
+functions, so that ProcessingStage can run them in a thread or process 
+pool, off the event loop that services the sensor.
+"""
+
+import asyncio as aio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+# absolute sample indices (counted from the first sample fed to the
+# detector) of newly confirmed beats; one entry per beat in each array
+Beats=namedtuple('Beats', ['r_peaks', 'q_peaks', 's_peaks'])
+
+
+class StreamingPeakDetector:
+    """ Pan-Tompkins R peak detector working on a stream of ECG samples.
+
+    Attributes:
+
+    position: number of samples processed so far; the absolute index of
+              the next sample
+    """
+
+    def __init__(self, sampling_rate=130, band=(5.0, 15.0),
+                 integration=0.150, refractory=0.200, learning=2.0,
+                 qs_window=0.080):
+        """ Init the StreamingPeakDetector object.
+
+        Args:
+
+        sampling_rate: sampling rate of the ECG in Hz (130 on the H10)
+        band: pass band of the QRS filter in Hz
+        integration: length of the moving integration window in s
+        refractory: minimum time between beats in s
+        learning: length of the signal used to initialise the thresholds,
+                  in s; no beats are reported before that
+        qs_window: how far before and after the R peak to look for the Q
+                  and S points, in s
+        """
+        self.sampling_rate=sampling_rate
+        self._sos=butter(2, band, btype='bandpass', fs=sampling_rate,
+                         output='sos')
+        self._width=max(1, round(integration*sampling_rate))
+        self._refractory=round(refractory*sampling_rate)
+        self._learning=round(learning*sampling_rate)
+        self._qs=max(1, round(qs_window*sampling_rate))
+        # how far before an integrated peak the R peak can be
+        self._lookback=self._width+round(0.05*sampling_rate)
+        self.position=0
+        self.reset()
+
+    def reset(self):
+        """ Forget the signal seen so far, e.g. after a gap in the stream.
+        Sample indices keep counting from the current position. """
+        self._zi=None
+        self._filtered=np.zeros(0)    # tail for the derivative
+        self._squared=np.zeros(0)     # tail for the integration
+        self._integrated=np.zeros(0)  # tail for local maxima
+        self._raw=np.zeros(0)         # tail for locating R, Q and S
+        self._raw_start=self.position
+        self._start=self.position     # first sample since reset
+        self._learning_buffer=[]
+        self._spki=None
+        self._npki=None
+        self._last_beat=None
+        self._last_r=None # R peak of the last confirmed beat
+        self._rr=[]
+        self._noise_peaks=[]
+        self._pending=[] # integrated peaks waiting for samples after them
+
+    @property
+    def threshold(self):
+        """ Current detection threshold on the integrated signal """
+        return self._npki+0.25*(self._spki-self._npki)
+
+    def process(self, samples):
+        """ Feed new ECG samples.
+
+        Args:
+            samples: a 1-D array of ECG samples (any numeric type)
+        Returns:
+            A Beats tuple with the beats confirmed by these samples
+        """
+        samples=np.asarray(samples, dtype=float)
+        if len(samples)==0:
+            return self._beats([])
+        if self._zi is None:
+            # start the filter in steady state at the first sample, to
+            # avoid a large transient
+            self._zi=sosfilt_zi(self._sos)*samples[0]
+        filtered, self._zi=sosfilt(self._sos, samples, zi=self._zi)
+        self._raw=np.concatenate((self._raw, samples))
+        self.position+=len(samples)
+
+        # five-point derivative, squaring and moving window integration;
+        # each stage carries the tail it needs over from the last call
+        filtered=np.concatenate((self._filtered, filtered))
+        derivative=(2*filtered[4:]+filtered[3:-1]-filtered[1:-3]
+                    -2*filtered[:-4])/8
+        self._filtered=filtered[-4:]
+        squared=np.concatenate((self._squared, derivative**2))
+        cumulative=np.concatenate(([0.0], np.cumsum(squared)))
+        integrated=(cumulative[self._width:]-
+                    cumulative[:-self._width])/self._width
+        self._squared=squared[max(len(squared)-self._width+1, 0):]
+        # integrated[-1] refers to the last sample received
+        end=self.position
+        begin=end-len(integrated)
+
+        if self._spki==None:
+            self._learning_buffer.append(integrated)
+            learned=np.concatenate(self._learning_buffer)
+            if len(learned)<self._learning:
+                return self._beats([])
+            self._spki=learned.max()/3
+            self._npki=learned.mean()/2
+            self._learning_buffer=[]
+            integrated, begin=learned, end-len(learned)
+
+        # local maxima, with one sample of the last call carried over on
+        # each side
+        values=np.concatenate((self._integrated, integrated))
+        offset=begin-len(self._integrated)
+        peaks=np.flatnonzero((values[1:-1]>values[:-2]) &
+                             (values[1:-1]>=values[2:]))+1
+        self._integrated=values[-2:]
+        for peak in peaks:
+            self._classify(offset+peak, values[peak])
+        confirmed=self._resolve()
+        self._trim()
+        return self._beats(confirmed)
+
+    def _classify(self, index, value):
+        """ Decide whether a peak of the integrated signal is a beat """
+        if self._last_beat!=None and self._rr:
+            average=sum(self._rr)/len(self._rr)
+            if index-self._last_beat>1.66*average:
+                self._search_back()
+        if (self._last_beat!=None and
+            index-self._last_beat<self._refractory):
+            return
+        if value>self.threshold:
+            self._spki=0.125*value+0.875*self._spki
+            self._beat(index)
+        else:
+            self._npki=0.125*value+0.875*self._npki
+            self._noise_peaks.append((index, value))
+
+    def _search_back(self):
+        """ A beat is overdue: accept the largest noise peak since the
+        last beat if it is above half the threshold """
+        candidates=[(value, index) for index, value in self._noise_peaks
+                    if index-self._last_beat>=self._refractory]
+        if not candidates:
+            return
+        value, index=max(candidates)
+        if value>self.threshold/2:
+            self._spki=0.25*value+0.75*self._spki
+            self._noise_peaks=[(i, v) for i, v in self._noise_peaks
+                               if i>index]
+            self._beat(index)
+
+    def _beat(self, index):
+        """ Record a beat at an integrated peak """
+        if self._last_beat!=None:
+            self._rr=(self._rr+[index-self._last_beat])[-8:]
+        self._last_beat=index
+        self._noise_peaks=[]
+        self._pending.append(index)
+
+    def _resolve(self):
+        """ Locate R, Q and S for the pending beats with enough signal
+        after them; returns a list of (r, q, s) """
+        confirmed=[]
+        while self._pending and self._pending[0]+self._qs<self.position:
+            index=self._pending.pop(0)
+            low=max(index-self._lookback, self._start, self._raw_start)
+            window=self._raw[low-self._raw_start:index+1-self._raw_start]
+            r=low+int(np.argmax(window))
+            # two integrated peaks can lead back to the same QRS complex
+            if self._last_r!=None and r-self._last_r<self._refractory:
+                continue
+            self._last_r=r
+            q_low=max(r-self._qs, self._raw_start)
+            before=self._raw[q_low-self._raw_start:r-self._raw_start]
+            q=q_low+int(np.argmin(before)) if len(before) else r
+            after=self._raw[r+1-self._raw_start:r+1+self._qs-self._raw_start]
+            s=r+1+int(np.argmin(after)) if len(after) else r
+            confirmed.append((r, q, s))
+        return confirmed
+
+    def _trim(self):
+        """ Drop raw samples that no pending or future beat can need """
+        oldest=self._pending[0] if self._pending else self.position
+        keep=oldest-self._lookback-self._qs-self._refractory
+        if keep>self._raw_start:
+            self._raw=self._raw[keep-self._raw_start:]
+            self._raw_start=keep
+
+    @staticmethod
+    def _beats(confirmed):
+        """ Beats tuple from a list of (r, q, s) """
+        beats=np.array(confirmed, dtype=np.int64).reshape(-1, 3)
+        return Beats(beats[:, 0], beats[:, 1], beats[:, 2])
+
+
+class ProcessingStage:
+    """ Runs processing functions in a thread or process pool, so that 
+    CPU-bound work does not block the event loop. At most max_in_flight
+    calls are queued or running at any time: submit() waits for one to
+    finish before handing more work to the pool, so slow windows cannot
+    pile up in the pool. 
+
+    Functions that keep state between calls (such as 
+    ecg_signalprocessing) need workers=1, so that calls run one at a time
+    and in order; with a process pool, the state then lives in the worker
+    process. Functions and arguments must be picklable for a process 
+    pool. """
+
+    executors=['thread', 'process']
+
+    def __init__(self, executor='thread', max_in_flight=2, workers=1):
+        """ Init the ProcessingStage object. Must be called with the event
+        loop running.
+
+        Args:
+
+        executor: 'thread' or 'process'
+        max_in_flight: maximum number of calls submitted and not finished
+        workers: number of threads or processes in the pool
+        """
+        if executor not in self.executors:
+            raise RuntimeError(f"Unknown executor {executor}, use one of "
+                               f"{self.executors}")
+        pool=ThreadPoolExecutor if executor=='thread' else ProcessPoolExecutor
+        self._pool=pool(max_workers=workers)
+        self._slots=aio.Semaphore(max_in_flight)
+        self.in_flight=0
+
+    async def submit(self, function, *args):
+        """ Run function(*args) in the pool, waiting first for a free 
+        slot if max_in_flight calls are pending. Returns an asyncio
+        future with the result """
+        await self._slots.acquire()
+        future=aio.get_running_loop().run_in_executor(self._pool, function,
+                                                      *args)
+        self.in_flight+=1
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.in_flight-=1
+        self._slots.release()
+
+    def close(self):
+        """ Shut the pool down once pending calls are done """
+        self._pool.shutdown()
+
+
+# detector of ecg_signalprocessing, one for each process; created on
+# first use
+_detector=None
+
+
+def ecg_signalprocessing(samples, reset=False, sampling_rate=130):
+    """ Process a window of ECG with the streaming detector: return the
+    beats confirmed by its samples as a dictionary with "R Peaks", "Q 
+    Peaks" and "S Peaks" (sample indices relative to the window, 
+    negative for a beat confirmed late that falls before it) and "QRS 
+    Durations". Calls must come in stream order, from one thread; 
+    reset is True for a window that does not follow on from the last 
+    one. """
+    global _detector
+    if _detector==None:
+        _detector=StreamingPeakDetector(sampling_rate)
+    elif reset:
+        _detector.reset()
+
+    # the detector reports the beats confirmed by the new samples, with
+    # sample indices counted from the start of the stream
+    start=_detector.position
+    beats=_detector.process(samples)
+
+    # make the peaks relative to this window, as nk.ecg_process on the
+    # window used to return them; they keep their true position, so a 
+    # beat confirmed late can fall just before the window
+    r_peaks=beats.r_peaks-start
+    q_peaks=beats.q_peaks-start
+    s_peaks=beats.s_peaks-start
+
+    # QRS durations in s, on the scale the melody mapping was tuned with
+    samplingrate=50
+    qrs_durations=list((beats.s_peaks-beats.q_peaks)/samplingrate)
+
+    return {
+        "R Peaks": r_peaks,
+        "Q Peaks": q_peaks,
+        "S Peaks": s_peaks,
+        "QRS Durations": qrs_durations
+        }
+
+
+def rr_signalprocessing(heart_rates):
+    """ Heart rate values of a window, as gathered by a WindowAccumulator
+    from hr frames, as a dictionary with "RR Intervals" """
+    # the melody plays the values for longer than the accumulator keeps 
+    # its buffer, so they are copied (a handful of numbers per window)
+    return {
+        "RR Intervals": np.array(heart_rates, dtype=float)
+        } 
+
+
+def ppi_signalprocessing(data):
+    """ Beats of a window of PPI frames, in the format of 
+    ecg_signalprocessing and rr_signalprocessing """
+    # peak-to-peak intervals in ms, leaving out those the sensor flags as
+    # unreliable (blocker bit)
+    intervals=np.array([ppi for label, timestamp, ppidata in data
+                        for hr, ppi, error, blocker, contact in ppidata
+                        if not blocker], dtype=float)
+
+    # beat positions as sample indices, at the sampling rate 
+    # ecg_signalprocessing assumes for durations
+    samplingrate=50 
+    r_peaks=np.rint(np.cumsum(intervals)/1000*samplingrate).astype(int)
+
+    # rr values are instant heart rates, as in hr frames when INSTANT_RATE
+    # is set
+    return {
+        "R Peaks": r_peaks,
+        "Q Peaks": [],
+        "S Peaks": [],
+        "QRS Durations": []
+        }, {
+        "RR Intervals": 60000/intervals
+        }
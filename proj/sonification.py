@@ -0,0 +1,278 @@
+""" Long-lived pyo audio graph for the ECG melodies.
+
+SonificationEngine builds the voices of the melody once, when the
+session starts:
+    binaural beat   two sines, base_freq and base_freq+binaural_freq Hz
+    QRS             a sine whose pitch follows the QRS durations
+    gong            a gong sample struck at intervals set by the RR data
+    chime           a chime sample whose loudness follows the R peaks
+Each processed window then only pushes its data into the existing
+objects (update()), instead of building and leaking a new graph per
+window: the cost of a window is a few parameter writes.
+
+The gong and chime samples come from a SoundBank, which reads each sound
+file once, resamples it to the rate of the server and keeps it in a
+table in memory; voices play it from there, so no file is opened once
+the session is running.
+
+Gong strikes and chime rings are sequenced by the audio engine itself: 
+each window starts a one-shot Seq with its intervals, and writes its
+amplitudes into an Iter, which trigger the TrigEnv players without 
+calling back into Python, so a slow window in Python cannot make the 
+audio glitch.
+
+play_windows() plays a list of processed windows on a running server;
+render() does the same on pyo's offline server, writing a WAV file as
+fast as the CPU allows instead of in real time.
+"""
+
+import os
+from math import ceil
+from time import perf_counter
+import numpy as np
+from pyo import (Server, Pattern, Sig, Sine, SigTo, Seq, Iter, TrigEnv, 
+                 SndTable, DataTable, sndinfo)
+
+# the sounds shipped with the application
+SOUNDS=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sounds')
+
+QRS_NOTES=[60, 62, 64, 65, 67, 69, 71, 72]
+
+
+def midiToHz(midi_note):
+    """ Frequency in Hz of a MIDI note """
+    return 440*2**((midi_note-69)/12)
+
+
+def mapping(qrs_data, notes=QRS_NOTES):
+    """ Map QRS durations to melody notes: durations in (0, 1] are
+    split into 8 equal bands, one for each note; longer durations get
+    the note of the median duration """
+    events=[]
+    for item in qrs_data:
+        if item<=0:
+            band=0
+        elif item<=1:
+            band=ceil(item/0.125)-1
+        else:
+            band=4 # median duration
+        events.append(notes[band])
+    return events
+
+
+class SoundBank:
+    """ Sound files loaded once into memory, at the sampling rate of the
+    server, and shared by the voices that play them """
+
+    def __init__(self, server, directory=SOUNDS):
+        """ Init the SoundBank object. 
+
+        Args:
+
+        server: the pyo Server, booted
+        directory: where relative file names are looked up; by default
+                   the sounds directory next to this module, whatever 
+                   the working directory
+        """
+        self.server=server
+        self.directory=directory
+        self._tables={}
+
+    def table(self, name):
+        """ The table holding sound file name, loaded on first use """
+        if name not in self._tables:
+            self._tables[name]=self._load(os.path.join(self.directory, 
+                                                       name))
+        return self._tables[name]
+
+    def _load(self, path):
+        """ Read a sound file into a DataTable at the server rate """
+        info=sndinfo(path)
+        if info==None:
+            raise RuntimeError(f"Cannot read sound file {path}")
+        file_rate=info[2]
+        rate=self.server.getSamplingRate()
+        samples=np.atleast_2d(np.asarray(SndTable(path).getTable(all=True),
+                                         dtype=float))
+        if file_rate!=rate:
+            # linear interpolation is plenty for one-shot samples 
+            size=int(round(samples.shape[1]*rate/file_rate))
+            times=np.arange(size)*(file_rate/rate)
+            positions=np.arange(samples.shape[1])
+            samples=np.array([np.interp(times, positions, channel) 
+                              for channel in samples])
+        init=samples.tolist() if len(samples)>1 else samples[0].tolist()
+        return DataTable(size=samples.shape[1], chnls=len(samples), 
+                         init=init)
+
+    def player(self, name, trig, speed=1.0, mul=1.0):
+        """ A player of sound file name, which plays it from the start on
+        each trigger of trig. speed scales pitch and duration as in 
+        SfPlayer """
+        table=self.table(name)
+        dur=table.getSize()/self.server.getSamplingRate()/speed
+        return TrigEnv(trig, table=table, dur=dur, mul=mul)
+
+
+class SonificationEngine:
+    """ The audio graph of the melody, updated in place with the data of
+    each window. Must be created after the pyo server is booted. """
+
+    def __init__(self, server, sounds=None, gong='gong.wav', 
+                 chime='tinkle.wav', base_freq=40, binaural_freq=8):
+        """ Init the SonificationEngine object and start the binaural
+        beat; the other voices stay silent until the first update().
+
+        Args:
+
+        server: the pyo Server
+        sounds: the SoundBank the samples come from; by default, one
+                with the sounds of the application
+        gong, chime: sound files of the gong and chime, in sounds
+        base_freq: frequency of the binaural beat in the left ear (Hz)
+        binaural_freq: the right ear is binaural_freq Hz higher; alpha
+                       frequencies (8-13 Hz) are for anxiety/stress relief
+        """
+        self.server=server
+        self.sounds=SoundBank(server) if sounds==None else sounds
+        # binaural beat, one slightly different sine for each ear
+        self._left=Sine(freq=base_freq, mul=0.3).out(0)
+        self._right=Sine(freq=base_freq+binaural_freq, mul=0.4).out(1)
+        # QRS melody
+        self._qrs_freq=SigTo(midiToHz(QRS_NOTES[4]), time=0.05)
+        self._qrs_amp=SigTo(0, time=0.05)
+        self._qrs=Sine(freq=self._qrs_freq, mul=self._qrs_amp).out()
+        # gong, struck by a sequence of intervals set by the RR data; the
+        # players read their triggers through a Sig, which each window
+        # points at a new Seq
+        self._gong_trig=Sig(0)
+        self._gong_seq=None
+        self._gong=self.sounds.player(gong, self._gong_trig, speed=1.5, 
+                                      mul=0.5).out()
+        # chime, rung at a steady pace with an amplitude for each R peak;
+        # the amplitudes must step before the player reads them, so the 
+        # Iter is created first (pyo processes objects in creation order)
+        self._chime_trig=Sig(0)
+        self._chime_seq=None
+        self._chime_amp=Iter(self._chime_trig, choice=[0])
+        self._chime=self.sounds.player(chime, self._chime_trig, speed=0.75, 
+                                       mul=self._chime_amp).out()
+
+    @staticmethod
+    def _sequence(trig, time, seq):
+        """ Start a one-shot Seq, triggering now and then after each of
+        seq (in multiples of time), and point trig at it; the previous
+        sequence is cut short. Returns the Seq, to keep it alive """
+        # a new Seq rather than setSeq on a running one: setSeq only 
+        # takes effect when the current sequence ends, which would play
+        # every window's data one window late; and a stopped Seq or 
+        # Metro does not restart from the beginning on play()
+        sequence=Seq(time=time, seq=seq, poly=1, onlyonce=True).play()
+        trig.setValue(sequence)
+        return sequence
+
+    def update(self, ecgdata, rrdata):
+        """ Play a window: ecgdata and rrdata are dictionaries as returned
+        by the functions of signalprocessing.py """
+        self.update_qrs(ecgdata["QRS Durations"])
+        self.update_gong(rrdata["RR Intervals"])
+        self.update_chime(ecgdata["R Peaks"])
+
+    def update_qrs(self, qrs_durations):
+        """ Set the QRS note from the durations of a window; silent if
+        there are none (e.g. with beats from PPI) """
+        melody_events=mapping(qrs_durations)
+        if not melody_events:
+            self._qrs_amp.setValue(0)
+            return
+        # one voice: the last note of the window holds until the next
+        self._qrs_freq.setValue(midiToHz(melody_events[-1]))
+        self._qrs_amp.setValue(0.2)
+
+    def update_gong(self, rr_intervals):
+        """ Strike the gong at intervals set by the RR values of a window: 
+        once now, then after each value but the last, divided by 10 """
+        if len(rr_intervals)<2:
+            return
+        waits=[float(rr)/10 for rr in rr_intervals[:-1]]
+        self._gong_seq=self._sequence(self._gong_trig, 1, waits)
+
+    def update_chime(self, r_peaks):
+        """ Ring the chime for the R peaks of a window (all but the last),
+        with amplitudes proportional to the R peak positions in the 
+        window """
+        if len(r_peaks)<2:
+            return
+        # a beat confirmed late, before the window, rings at its start
+        self._chime_amp.setChoice([float(max(peak, 0))/100 
+                                   for peak in r_peaks[:-1]])
+        self._chime_amp.reset()
+        self._chime_seq=self._sequence(self._chime_trig, 1.75, 
+                                       [1]*(len(r_peaks)-1))
+
+    def stop(self):
+        """ Silence every voice """
+        for obj in [self._left, self._right, self._qrs, self._gong_seq,
+                    self._gong_trig, self._gong, self._chime_seq, 
+                    self._chime_trig, self._chime_amp, self._chime]:
+            if obj!=None:
+                obj.stop()
+
+
+def play_windows(engine, windows, span=5.6):
+    """ Play windows one every span seconds (of server time), starting 
+    with the next processing block.
+
+    Args:
+        engine: a SonificationEngine
+        windows: list of (ecgdata, rrdata) tuples, as taken by 
+            SonificationEngine.update()
+        span: time between windows in seconds
+
+    Returns:
+        the pyo Pattern that plays the windows; keep a reference to it 
+        for as long as they play
+    """
+    remaining=iter(windows)
+
+    def next_window():
+        window=next(remaining, None)
+        if window==None:
+            pattern.stop()
+            return
+        engine.update(*window)
+
+    pattern=Pattern(next_window, time=span)
+    pattern.play()
+    return pattern
+
+
+def render(windows, path, span=5.6, tail=10.0, sampling_rate=44100, 
+           channels=2):
+    """ Render the melody of windows (as in play_windows) to a WAV file,
+    on pyo's offline server. No other pyo server can be running.
+
+    Args:
+        windows: list of (ecgdata, rrdata) tuples
+        path: the WAV file to write
+        span: time between windows in seconds
+        tail: seconds rendered after the last window, to let it ring out
+        sampling_rate, channels: format of the file
+
+    Returns:
+        the speed-up factor: seconds of audio rendered per second of 
+        wall clock time
+    """
+    duration=len(windows)*span+tail
+    server=Server(sr=sampling_rate, nchnls=channels, duplex=0, 
+                  audio='offline').boot()
+    server.recordOptions(dur=duration, filename=path, fileformat=0, 
+                         sampletype=0)
+    engine=SonificationEngine(server)
+    pattern=play_windows(engine, windows, span)
+    start=perf_counter()
+    # offline, start() returns once duration seconds have been rendered
+    server.start()
+    elapsed=perf_counter()-start
+    server.shutdown()
+    return duration/elapsed
@@ -6,6 +6,10 @@ from pyo import *
 from scipy.signal import find_peaks
 from collections import deque
 from appJar import gui 
+import sys
+# Allow importing the csv loader from the proj directory
+sys.path.append('../proj')
+from recording import parse_ecg_column
 
 
 file_path_qrs = 'qrsdata.csv'  # Adjust the path as necessary
@@ -43,9 +47,12 @@ def signalProcessing(data):
     search_window = 50
 
 
+    # parse all ECG lists at once; list i is samples[offsets[i]:offsets[i+1]]
+    samples, offsets = parse_ecg_column(data['ecg'].tolist())
+
     # loop through the desired ECG lists
-    for index, row in data.iterrows():
-        ecg_list = np.array(eval(row['ecg']))  # Convert string list to actual list
+    for index in range(len(data)):
+        ecg_list = samples[offsets[index]:offsets[index+1]]
         relative_time_s = data['relative_time_s']
 
         